@@ -1,7 +1,8 @@
 import hashlib
+from records import new_record
 import copy
 import networkx as nx
-from config import ASN_nodes, state, AS_topo, topo_mutex, asn_nodes_mutex
+from config import AS_registry, state, AS_topo, topo_mutex, signature_cache
 
 
 class BGP_Transaction:
@@ -36,7 +37,7 @@ class BGP_Transaction:
         as_source_public_key = self.find_asn_public_key()
 
         if as_source_public_key is not None:
-            return as_source_public_key.verify(trans_hash.encode(), self.signature)
+            return signature_cache.verify(as_source_public_key, trans_hash, self.signature)
         else:
             return False
 
@@ -46,14 +47,7 @@ class BGP_Transaction:
 
         :return: <RSA key> The public key of the node, or None if the key is not found.
         """
-        ASN_pkey = None
-        asn_nodes_mutex.acquire()
-        for asn in ASN_nodes:  # find ASN public key
-            if self.as_source == asn[2]:
-                ASN_pkey = asn[-1]
-                break
-        asn_nodes_mutex.release()
-        return ASN_pkey
+        return AS_registry.public_key(self.as_source)
 
     def calculate_hash(self):
         """
@@ -103,19 +97,11 @@ class BGP_Transaction:
         """
         Returns a valid transaction to be added to a block in the blockchain.
 
-        :return: <dict> A valid transaction, or None if the transaction is not valid.
+        :return: <TransactionRecord> A valid transaction, or None if the transaction is not valid.
         """
         if self.validate_transaction():
-            transaction = {
-                'trans': {
-                    'type': self.type,
-                    'input': self.get_input(),
-                    'output': self.get_output(),
-                    'timestamp': self.time,
-                    'txid': self.calculate_hash()
-                },
-                'signature': self.signature
-            }
+            transaction = new_record(self.type, self.get_input(), self.get_output(), self.time, self.calculate_hash(),
+                                     self.signature)
             return transaction
         else:
             return None
@@ -185,18 +171,14 @@ class BGP_Announce(BGP_Transaction):
 
         :return: <bool> True if they are in the network, False otherwise.
         """
-        ASes = ['0']
-        asn_nodes_mutex.acquire()
-        for i in range(len(ASN_nodes)):
-            ASes.append(ASN_nodes[i][2])
-        asn_nodes_mutex.release()
+        ASes = AS_registry.asns()
 
         for AS in self.as_dest_list:
-            if AS not in ASes:
+            if AS != '0' and AS not in ASes:
                 return False
-            
+
         for AS in self.as_source_list:
-            if AS not in ASes:
+            if AS != '0' and AS not in ASes:
                 return False
 
         return True
@@ -1,5 +1,8 @@
 import  json
 import hashlib
+from time import time
+import merkle
+from records import TransactionRecord
 
 """
 The Block module. Includes all the functionality for the creation of a block in the blockchain
@@ -7,36 +10,78 @@ The Block module. Includes all the functionality for the creation of a block in
 
 
 class Block:
-    def __init__(self, index, timestamp, transactions, previousHash):
+    __slots__ = ('timestamp', 'transactions', 'previousHash', 'merkle_root', 'nonce', 'index', 'hash', 'signature',
+                 'miner', 'mined_timestamp', 'difficulty')
+
+    def __init__(self, index, timestamp, transactions, previousHash, difficulty=4, merkle_root=None):
         self.timestamp = timestamp
-        self.transactions = []
-        self.transactions.extend(transactions)
+        self.set_transactions(transactions)
         self.previousHash = previousHash
+        self.merkle_root = merkle_root if merkle_root is not None else self.calculate_merkle_root()
         self.nonce = 0
         self.index = index
+        self.difficulty = difficulty  # the number of leading zeroes the hash of this block must have
         self.hash = self.calculate_hash()
         self.signature = None
         self.miner = None
         self.mined_timestamp = None
 
-    def proof_of_work(self):
+    def proof_of_work(self, workers=1, cancel=None, batch_size=10000):
         """
         Simple Proof of Work Algorithm:
-            - Find a number, nonce, such that the hash of the block contains 4 leading zeros.
+            - Find a number, nonce, such that the hash of the block contains as many leading zeros
+              as the difficulty of the block.
+
+        The search checks the cancel event between batches of nonces and gives up if it is set,
+        e.g. when a chain with more work was adopted while mining.
+
+        :param workers: <int> The number of processes that search for the nonce in parallel.
+        :param cancel: <threading.Event> Aborts the search when set.
+        :param batch_size: <int> How many nonces are tried between two checks of the cancel event.
+        :return: <dict> The hashes/sec of every worker, { worker id : hashes/sec }, None if the search was cancelled.
         """
-        while not self.valid_proof(self.nonce):
-            self.nonce += 1
+        if workers > 1:
+            from miner import parallel_proof_of_work
+            nonce, hash_rates = parallel_proof_of_work(self, workers, batch_size, cancel)
+            if nonce is None:
+                return None
+            self.nonce = nonce
+        else:
+            from miner import search_nonce
+            start_time = time()
+            start_nonce = self.nonce
+            header_prefix = self.header_prefix()
+            nonce = None
+            while nonce is None:
+                if cancel is not None and cancel.is_set():
+                    return None
+                nonce = search_nonce(header_prefix, self.nonce, self.nonce + batch_size, 1, self.difficulty)
+                if nonce is None:
+                    self.nonce += batch_size
+            self.nonce = nonce
+            elapsed = time() - start_time
+            hash_rates = {0: (self.nonce - start_nonce + 1) / elapsed if elapsed > 0 else 0.0}
         self.hash = self.calculate_hash()  # update the hash of the block with the new nonce value
+        return hash_rates
 
     def valid_proof(self, nonce):
         """
-        Validates the Proof: Does the hash of the block contain 4 leading zeroes?
+        Validates the Proof: Does the hash of the block contain as many leading zeroes as its difficulty?
 
         :param nonce: <int>
         :return: <bool> True if correct, False otherwise.
         """
         block_hash = self.calculate_hash(nonce)
-        return block_hash[:4] == "0000"
+        return block_hash[:self.difficulty] == "0" * self.difficulty
+
+    def header_prefix(self):
+        """
+        The part of the hashed block header that does not depend on the nonce.
+        The timestamp and the difficulty are hashed, so they can't be changed without mining the block again.
+
+        :return: <bytes> The bytes that come before the nonce in calculate_hash.
+        """
+        return '{}{}{}{}'.format(self.timestamp, self.previousHash, self.difficulty, self.merkle_root).encode()
 
     def calculate_hash(self, nonce=None):
         """
@@ -44,10 +89,57 @@ class Block:
 
         :return: <str> The hash of the block.
         """
-        block_str = '{}{}{}'.format(self.timestamp, self.previousHash, nonce or self.nonce).encode()
+        block_str = self.header_prefix() + str(nonce or self.nonce).encode()
         block_hash = hashlib.sha256(block_str).hexdigest()
         return block_hash
 
+    def calculate_merkle_root(self):
+        """
+        Calculates the root of the Merkle tree of the block's transactions.
+        The root is part of the hashed header, so the hash of the block commits to its transactions.
+
+        :return: <str> The Merkle root.
+        """
+        return merkle.merkle_root([transaction.leaf_hash() for transaction in self.transactions])
+
+    def set_transactions(self, transactions):
+        """
+        Sets the transactions of the block.
+
+        :param transactions: <list> Transaction records, or transactions in their dictionary form.
+        """
+        self.transactions = [TransactionRecord.from_dict(transaction) for transaction in transactions]
+
+    def header(self):
+        """
+        Returns the header of the block, i.e. every field except the transactions.
+        The header is enough to check the Proof of Work and the signature of the block.
+
+        :return: <dict> The block header.
+        """
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previousHash': self.previousHash,
+            'merkle_root': self.merkle_root,
+            'nonce': self.nonce,
+            'difficulty': self.difficulty,
+            'hash': self.hash,
+            'miner': self.miner,
+            'signature': self.signature,
+            'mined_timestamp': self.mined_timestamp
+        }
+
+    def to_dict(self):
+        """
+        Returns the block as a dictionary, for json export.
+
+        :return: <dict> The block header and its transactions.
+        """
+        block = self.header()
+        block['transactions'] = [transaction.to_dict() for transaction in self.transactions]
+        return block
+
     def sign(self, signature):
         """
         The miner signs the block.
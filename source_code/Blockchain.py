@@ -1,12 +1,29 @@
 import json
 import requests
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
 import networkx as nx
 from time import time
+from collections import OrderedDict, deque
 from urllib.parse import urlparse
 from Block import Block
-from config import state, txid_to_block, ASN_nodes, pending_transactions, as2pref, pref2as_pyt
+from merkle import merkle_proof
+from records import GenesisRecord, TransactionRecord, freeze
+import wire
+import checkpoint
+from block_store import BlockStore, ForkedChain
+from validator import verify_signatures
+from outbound import Outbound, Batcher
+from config import state, txid_to_block, AS_registry, pending_transactions, as2pref, pref2as_pyt
 from config import my_assignments, node_key, AS_topo, invalid_transactions
-from config import mutex, topo_mutex, asn_nodes_mutex, bc_nodes_mutex
+from config import mutex, topo_mutex, bc_nodes_mutex, mining_cancel
+from config import initial_difficulty, retarget_interval, target_block_time, work_cache_size, work_mutex
+from config import sync_page_size, sync_header_page_size, sync_workers, peer_timeout, sync_deadline, sync_chunk_size
+from config import max_undo_depth, checkpoint_interval
+from config import validation_workers, validation_chunk_size, validated_cache_size, validated_mutex
+from config import serialized_cache_size, serialized_mutex, relay_cache_size, relay_mutex, signature_cache
+from config import outbound_queue_size, outbound_retries, outbound_backoff, relay_batch_window, relay_batch_size
 
 
 """
@@ -19,6 +36,20 @@ class Blockchain:
         self.chain = []
         self.nodes = set()
         self.check_before_mining = False
+        self.binary_wire = False  # use the binary wire format instead of JSON with other nodes
+        self.url = None  # the url of this node, the neighbors ask it for the transactions it announced
+        self.applied_height = 0  # the number of blocks of the chain whose transactions are applied to the state
+        self.undo_logs = {}  # { block index : the state and the topologies the block changed, before the change }
+        self.checkpoint_path = None  # the file the checkpoints are stored in, None to disable them
+        self.checkpoint_height = 0  # the height of the last checkpoint
+        self.checkpoint_writer = ThreadPoolExecutor(max_workers=1)  # writes the checkpoints in order, one at a time
+        self.validated_headers = OrderedDict()  # { (hash, miner, signature) : None }, the last validated headers
+        self.validation_pool = None  # the ProcessPoolExecutor of the validation processes, started when first needed
+        self.serialized_blocks = OrderedDict()  # { block hash : the block in JSON }, the last serialized blocks
+        self.chain_works = OrderedDict()  # { block hash : the cumulative work of the chain up to the block }
+        self.outbound = Outbound(outbound_queue_size, outbound_retries, outbound_backoff, peer_timeout)
+        self.relay_transactions = OrderedDict()  # { txid : the transaction as a dict }, the last announced ones
+        self.transaction_batcher = Batcher(self.announce_transactions, relay_batch_window, relay_batch_size)
 
         # Create the genesis block
         self.create_genesis_block()
@@ -34,23 +65,31 @@ class Blockchain:
             for pref in as2pref[AS]:
                 input.append((pref, AS))
                 output.append((pref, AS))
+
+        self.init_state()
+
+        genesis_transaction = [GenesisRecord(input, output, time())]
+
+        genesis_block = Block(len(self.chain), time(), genesis_transaction, -1, initial_difficulty)
+        self.add_block(genesis_block)
+        self.applied_height = 1
+
+    def init_state(self):
+        """
+        Sets the state, the topologies and the txid_to_block dictionary to the ones of the genesis block.
+        """
+        state.clear()
+        AS_topo.clear()
+        txid_to_block.clear()
+        for AS in as2pref.keys():
+            for pref in as2pref[AS]:
                 state[pref] = []
                 AS_topo[pref] = nx.DiGraph()
                 for asn in pref2as_pyt[pref]:
                     state[pref].append((asn, 1000, True, -1))
                     AS_topo[pref].add_edge(asn, pref)
 
-        txid_to_block[-1] = len(self.chain)
-
-        genesis_transaction = [{
-            'input': input,
-            'output': output,
-            'txid': -1,
-            'timestamp': time(),
-        }]
-
-        genesis_block = Block(len(self.chain), time(), genesis_transaction, -1)
-        self.add_block(genesis_block)
+        txid_to_block[-1] = 0
 
     def add_block(self, block):
         """
@@ -58,6 +97,45 @@ class Blockchain:
         :param block: <Block> A Block object
         """
         self.chain.append(block)
+        self.mark_validated(block.hash, block)  # our own blocks are valid
+        self.serialize_block(block)
+
+    def serialize_block(self, block):
+        """
+        Returns the JSON form of a block. Every block is serialized once and kept for the next requests,
+        only the last serialized_cache_size blocks are kept. They are kept by block hash, the blocks of our chain
+        are our own or passed valid_headers, which checks that every block has the hash it claims.
+
+        :param block: <Block>
+        :return: <bytes> The block in JSON.
+        """
+        serialized_mutex.acquire()
+        serialized = self.serialized_blocks.get(block.hash)
+        if serialized is not None:
+            self.serialized_blocks.move_to_end(block.hash)
+        serialized_mutex.release()
+        if serialized is not None:
+            return serialized
+
+        serialized = json.dumps(block.to_dict()).encode()
+        serialized_mutex.acquire()
+        self.serialized_blocks[block.hash] = serialized
+        if len(self.serialized_blocks) > serialized_cache_size:
+            self.serialized_blocks.popitem(last=False)
+        serialized_mutex.release()
+        return serialized
+
+    def use_block_store(self, store):
+        """
+        Moves the chain to a block store on disk.
+        An empty store gets our chain. Otherwise the chain of the store replaces ours, and the state must be
+        loaded from a checkpoint or rebuilt afterwards.
+
+        :param store: <BlockStore>
+        """
+        if len(store) == 0:
+            store.extend(self.chain)
+        self.chain = store
 
     def get_last_block(self):
         """
@@ -66,120 +144,565 @@ class Blockchain:
         """
         return self.chain[-1]
 
-    def valid_chain(self, chain):
+    def next_difficulty(self, chain, index):
         """
-        Determine if a given blockchain is valid
+        Finds the difficulty that the block at this index of the chain must have.
+        Every retarget_interval blocks the difficulty is recalculated from the time between the timestamps
+        of the previous retarget_interval blocks, so that a block is mined every target_block_time secs.
+        Only the timestamps are used, they are part of the hashed header.
+        Every extra zero makes mining 16 times harder, so the difficulty only changes if the blocks were
+        mined more than 4 times faster or slower than the target.
+
+        :param chain: <list> A blockchain, only the blocks before index are used.
+        :param index: <int> The index of the block.
+        :return: <int> The number of leading zeroes the hash of the block must have.
+        """
+        if index <= 1:
+            return initial_difficulty  # the genesis block and the first mined block
 
-        :param chain: <list> A blockchain
-        :return: <bool> True if valid, False if not
+        previous_difficulty = chain[index - 1].difficulty
+        if (index - 1) % retarget_interval != 0 or index - 1 < retarget_interval:
+            return previous_difficulty
+
+        # the average time between two consecutive blocks of the window
+        window_time = chain[index - 1].timestamp - chain[index - 1 - retarget_interval].timestamp
+        average_time = window_time / retarget_interval
+
+        if average_time * 4 < target_block_time:
+            return previous_difficulty + 1
+        elif average_time > target_block_time * 4 and previous_difficulty > 1:
+            return previous_difficulty - 1
+        return previous_difficulty
+
+    def chain_work(self, chain):
         """
-        last_block = chain[0]
-        current_index = 1
+        Calculates the cumulative work of a chain, i.e. the number of hashes it takes on average to mine its blocks.
+        A block with difficulty d takes 16 ** d hashes. The chain with the most work is chosen over the others,
+        not the longest one, so a long chain of easy blocks doesn't replace a shorter chain of harder blocks.
 
-        while current_index < len(chain):
-            block = chain[current_index]
+        The cumulative work up to the last work_cache_size blocks is remembered by block hash,
+        so only the blocks after the last remembered block of the chain are added up.
+        A block hash identifies the block and the blocks before it only if it was checked, so the chain must be
+        validated first (see first_invalid_header), otherwise a node could claim the hash of a chain with more work.
 
-            # Check that the hash of the block is correct
-            if block.previousHash != last_block.calculate_hash():
-                return False
+        :param chain: <list> A valid blockchain, e.g. our chain or a chain that passed valid_headers.
+        :return: <int> The cumulative work of the chain.
+        """
+        index = len(chain)
+        work = None
+        while index > 0 and work is None:
+            work_mutex.acquire()
+            work = self.chain_works.get(chain[index - 1].hash)
+            work_mutex.release()
+            if work is None:
+                index -= 1
+        work = work or 0
+
+        for index in range(index, len(chain)):
+            block = chain[index]
+            work += 16 ** block.difficulty
+            work_mutex.acquire()
+            self.chain_works[block.hash] = work
+            self.chain_works.move_to_end(block.hash)
+            if len(self.chain_works) > work_cache_size:
+                self.chain_works.popitem(last=False)
+            work_mutex.release()
+        return work
+
+    def valid_chain(self, chain, start=1):
+        """
+        Determine if a given blockchain is valid
 
-            # Check that the Proof of Work is correct
-            if not block.valid_proof(block.nonce):
-                return False
+        :param chain: <list> A blockchain
+        :param start: <int> The index of the first block to check. The blocks before it are already known to be valid.
+        :return: <bool> True if valid, False if not
+        """
+        if not self.valid_headers(chain, start):
+            return False
 
-            # check if you can verify the block's miner origin
-            if not self.verify_signature(block):
+        for index in range(max(start, 1), len(chain)):
+            if not self.valid_body(chain[index]):
                 return False
+        return True
 
-            # check if a transaction in a block is in the invalid chain list
-            if self.check_for_invalid_tran(block):
-                return False
+    def valid_headers(self, chain, start=1):
+        """
+        Determine if the headers of a given blockchain are valid.
+        Only the header fields of the blocks are used, so the blocks don't need their transactions.
 
-            last_block = block
-            current_index += 1
+        :param chain: <list> A blockchain
+        :param start: <int> The index of the first block to check. The blocks before it are already known to be valid.
+        :return: <bool> True if valid, False if not
+        """
+        invalid_index = self.first_invalid_header(chain, start)
+        if invalid_index is not None:
+            print("Block {} of the chain is not valid".format(invalid_index))
+            return False
         return True
 
-    def verify_signature(self, block):
+    def first_invalid_header(self, chain, start=1):
         """
-        Verifies the origin of the miner of the block
+        Finds the first block of a chain with an invalid header.
 
-        :param block: <Block>
-        :return: <bool> True if signature is verified, False if not.
+        The hash of every block is calculated once, and the hash a node sent with the block, the hash links,
+        the difficulties and the Proof of Work are checked here in order. The hash of a valid block can be used
+        to identify it, e.g. to find the fork of two chains or in the caches that are keyed by block hash. The signatures of the blocks that were not validated before and are not in
+        the signature cache are checked in chunks of validation_chunk_size blocks on a pool of validation_workers
+        processes (see validation_executor), and the results are added to the signature cache.
+        The chunks are checked in order, so the search stops at the chunk of the first invalid signature.
+
+        :param chain: <list> A blockchain
+        :param start: <int> The index of the first block to check. The blocks before it are already known to be valid.
+        :return: <int> The index of the first invalid block, None if all the blocks are valid.
         """
-        ASN_pkey = None
-        asn_nodes_mutex.acquire()
-        for asn in ASN_nodes:  # find miner's public key
-            if block.miner == asn[2]:
-                ASN_pkey = asn[-1]
-                break
-        asn_nodes_mutex.release()
+        start = max(start, 1)
+        if start >= len(chain):
+            return None
 
-        if ASN_pkey is not None:
+        invalid_index = None
+        unchecked = []  # [ (block index, block hash), ... ], the blocks whose signature must be checked
+        last_hash = chain[start - 1].calculate_hash()
+        for index in range(start, len(chain)):
+            block = chain[index]
             block_hash = block.calculate_hash()
-            return ASN_pkey.verify(block_hash.encode(), block.signature)
+            # Check that the block has the hash it claims, that it points to the previous block,
+            # that it was mined with the difficulty in force at its height and that its Proof of Work is correct
+            if block.hash != block_hash or block.previousHash != last_hash \
+                    or block.difficulty != self.next_difficulty(chain, index) \
+                    or block_hash[:block.difficulty] != "0" * block.difficulty:
+                invalid_index = index
+                break
+            if not self.is_validated(block_hash, block):
+                # the signature may have been verified before, e.g. in another chain that was validated
+                key = AS_registry.public_key(block.miner)
+                valid = signature_cache.lookup(key, block_hash, block.signature) if key is not None else False
+                if valid is None:
+                    unchecked.append((index, block_hash))
+                elif valid:
+                    self.mark_validated(block_hash, block)
+                else:
+                    invalid_index = index
+                    break
+            last_hash = block_hash
+
+        exported_keys = {}  # { miner : exported public key }, the keys are sent to the validation processes
+        chunks = []
+        for chunk_start in range(0, len(unchecked), validation_chunk_size):
+            chunk = []
+            for index, block_hash in unchecked[chunk_start:chunk_start + validation_chunk_size]:
+                block = chain[index]
+                if block.miner not in exported_keys:
+                    key = AS_registry.public_key(block.miner)
+                    exported_keys[block.miner] = key.exportKey() if key is not None else None
+                chunk.append((block_hash, block.signature, exported_keys[block.miner]))
+            chunks.append(chunk)
+
+        if len(chunks) > 1 and validation_workers > 1:
+            executor = self.validation_executor()
+            results = [executor.submit(verify_signatures, chunk) for chunk in chunks]
         else:
+            executor = None
+            results = chunks
+
+        try:
+            position = 0
+            for result in results:
+                checked = result.result() if executor is not None else verify_signatures(result)
+                for valid in checked:
+                    index, block_hash = unchecked[position]
+                    block = chain[index]
+                    key = AS_registry.public_key(block.miner)
+                    if key is not None:
+                        signature_cache.add(key, block_hash, block.signature, valid)
+                    if not valid:
+                        return index
+                    self.mark_validated(block_hash, block)
+                    position += 1
+            return invalid_index
+        except BrokenProcessPool:
+            self.validation_pool = None  # a validation process died, the next validation starts a new pool
+            raise
+        finally:
+            if executor is not None:
+                for result in results:
+                    result.cancel()  # the chunks after an invalid one are not checked
+
+    def validation_executor(self):
+        """
+        Returns the pool of validation processes. It is started the first time a long chain is validated
+        and reused by the next validations.
+        The processes are started with forkserver (spawn where it is not available) instead of being forked
+        from the node, whose threads may hold locks that a forked process would copy in their locked state.
+
+        :return: <ProcessPoolExecutor>
+        """
+        validated_mutex.acquire()
+        if self.validation_pool is None:
+            start_methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in start_methods else 'spawn')
+            self.validation_pool = ProcessPoolExecutor(max_workers=validation_workers, mp_context=context)
+        executor = self.validation_pool
+        validated_mutex.release()
+        return executor
+
+    def is_validated(self, block_hash, block):
+        """
+        Checks if a block header was validated before.
+
+        :param block_hash: <str> The calculated hash of the block.
+        :param block: <Block>
+        :return: <bool> True if the header was validated before, False if not.
+        """
+        key = (block_hash, block.miner, freeze(block.signature))
+        validated_mutex.acquire()
+        found = key in self.validated_headers
+        if found:
+            self.validated_headers.move_to_end(key)
+        validated_mutex.release()
+        return found
+
+    def mark_validated(self, block_hash, block):
+        """
+        Remembers that the Proof of Work and the signature of a block header are valid.
+        Only the last validated_cache_size headers are remembered.
+
+        :param block_hash: <str> The calculated hash of the block.
+        :param block: <Block>
+        """
+        key = (block_hash, block.miner, freeze(block.signature))
+        validated_mutex.acquire()
+        self.validated_headers[key] = None
+        self.validated_headers.move_to_end(key)
+        if len(self.validated_headers) > validated_cache_size:
+            self.validated_headers.popitem(last=False)
+        validated_mutex.release()
+
+    def valid_body(self, block):
+        """
+        Determine if the transactions of a block are valid.
+
+        :param block: <Block>
+        :return: <bool> True if valid, False if not
+        """
+        # Check that the transactions of the block are the ones its header commits to
+        if block.merkle_root != block.calculate_merkle_root():
             return False
 
+        # check if a transaction in a block is in the invalid chain list
+        if self.check_for_invalid_tran(block):
+            return False
+        return True
+
     def check_for_invalid_tran(self, block):
         """
 
         :param block: <Block>
         :return: <bool> True if the txid is of an invalid transaction, False if not.
         """
-        for i in range(len(block.transactions)):
-            transaction = block.transactions[i]['trans']
-
-            if transaction['txid'] in invalid_transactions:
+        for transaction in block.transactions:
+            if transaction.txid in invalid_transactions:
                 return True
         return False
 
     def resolve_conflicts(self):
         """
         This is our Consensus Algorithm, it resolves conflicts
-        by replacing our chain with the longest one in the network.
+        by replacing our chain with the one with the most cumulative work in the network (see chain_work).
+
+        The neighbors first send the height, the hash and the work of the tip of their chains. Only the blocks after
+        the last block we have in common with a chain with more work are downloaded, so the cost of a sync
+        depends on the number of new blocks and not on the length of the chain.
+
+        The neighbors are queried in parallel and every chain is validated as soon as it arrives.
+        The valid chain with the most work that arrived before the deadline wins, slow or dead neighbors are skipped.
 
         :return: <bool> True if our chain was replaced, False if not
         """
-        new_chain = None
-
-        # We are looking for chains longer than ours
         mutex.acquire()
-        neighbors = self.nodes
-        max_length = len(self.chain)
+        neighbors = list(self.nodes)
+        our_chain = self.chain.view() if isinstance(self.chain, BlockStore) else list(self.chain)
         mutex.release()
 
-        for node in neighbors:
-            try:
-                response = requests.get('{}/chain'.format(node[0]))  # possible deadlock here
-            except:
-                print("Could not contact node {}. Moving on...".format(node[0]))
-                continue
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain_received = response.json()['chain']
-                chain = self.dict_to_block_chain(chain_received)
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
-
-        # Replace our own chain if we have discovered a new valid chain longer than ours
-        if new_chain is not None:
-            mutex.acquire()
-            self.chain = new_chain
-            self.txid_to_block_update()
-            self.state_update()
+        best_chain = None
+        best_work = self.chain_work(our_chain)
+        executor = ThreadPoolExecutor(max_workers=sync_workers)
+        futures = {executor.submit(self.query_neighbor, node[0], our_chain): node[0] for node in neighbors}
+        done = set()
+        try:
+            for future in as_completed(futures, timeout=sync_deadline):
+                done.add(future)
+                try:
+                    new_chain = future.result()
+                except Exception:
+                    print("Could not contact node {}. Moving on...".format(futures[future]))
+                    continue
+                if new_chain is None:
+                    continue
+                new_work = self.chain_work(new_chain)
+                if new_work > best_work:
+                    if best_chain is not None:
+                        best_chain.discard()
+                    best_chain, best_work = new_chain, new_work
+                else:
+                    new_chain.discard()
+        except TimeoutError:
+            print("Not all the neighbors answered in {} secs.".format(sync_deadline))
+        for future in futures:
+            if future not in done:
+                future.add_done_callback(self.discard_late_chain)  # the chains that arrive after the deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        if best_chain is None:
+            return False
+
+        # Replace our own chain if it still has less work than the new valid chain
+        mutex.acquire()
+        try:
+            if best_chain.is_stale():
+                # our chain was reorganized during the sync, the new chain may be built on blocks we no longer have
+                print("Our chain changed during the sync. Dropping the new chain...")
+                return False
+            if best_work <= self.chain_work(self.chain):
+                return False
+            if not self.replace_chain(best_chain):
+                return False
             self.check_before_mining = True
-            mutex.release()
+            mining_cancel.set()  # the block being mined (if any) no longer extends our chain
             return True
-        else:
-            return False
+        finally:
+            mutex.release()
+            best_chain.discard()
+
+    @staticmethod
+    def discard_late_chain(future):
+        """
+        Removes the temporary store of a chain that was downloaded after the sync deadline.
+
+        :param future: <Future> The query of a neighbor.
+        """
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            future.result().discard()
+
+    def query_neighbor(self, node, our_chain):
+        """
+        Asks a neighbor for the tip of its chain and downloads its chain if it has more work than ours.
+        The work the neighbor claims is checked again on the downloaded chain.
+
+        :param node: <str> The url of the node.
+        :param our_chain: <list> Our blockchain.
+        :return: <list> The neighbor's valid chain, None if it has no more work than ours or is not valid.
+        """
+        tip = self.request_tip(node)
+        if tip is None or tip['work'] <= self.chain_work(our_chain):
+            return None
+        return self.sync_chain(node, our_chain, tip['length'])
+
+    def sync_chain(self, node, our_chain, length):
+        """
+        Downloads a node's chain after the last block it has in common with our chain, headers first.
+        The headers are downloaded first and all of them are validated with one valid_headers call,
+        so the Proof of Work and the signatures of a long chain are checked on the validation processes.
+        The bodies are downloaded only if the headers are valid and have more work than our chain.
+        They are downloaded in pages and decoded while they arrive, every body is checked against the Merkle root
+        of its header as soon as it arrives and the download stops at the first invalid body.
+
+        :param node: <str> The url of the node.
+        :param our_chain: <list> Our blockchain.
+        :param length: <int> The length of the node's chain.
+        :return: <ForkedChain> The node's chain, None if it is not valid or a request failed.
+        """
+        fork_index = self.find_common_ancestor(node, our_chain, length)
+        if fork_index is None:
+            return None
+
+        headers = self.download_headers(node, fork_index, length)
+        if not headers:
+            return None
+        header_chain = ForkedChain(our_chain, fork_index)
+        header_chain.extend(headers)
+        # the work is added up after the headers are validated, the work cache is keyed by their hashes
+        if not self.valid_headers(header_chain, fork_index) \
+                or self.chain_work(header_chain) <= self.chain_work(our_chain):
+            return None
+
+        end = len(header_chain)
+        del header_chain  # a block is only kept by new_chain once its body is attached
+
+        # The blocks are spilled to a temporary store if our chain is in a store, the fork can be at the genesis block
+        new_chain = ForkedChain(our_chain, fork_index, spill=True, cache_size=sync_page_size)
+        headers = deque(headers)
+        valid = False
+        try:
+            while headers:
+                start = len(new_chain)
+                page = []
+                bodies = self.stream_bodies(node, start, end)
+                try:
+                    for body in bodies:
+                        if not headers or body['index'] != start + len(page):
+                            return None
+                        block = headers.popleft()  # the header of the body
+                        block.set_transactions(body['transactions'])
+                        if not self.valid_body(block):
+                            return None  # the rest of the page is not downloaded
+                        page.append(block)
+                finally:
+                    bodies.close()  # closes the connection if the download stopped early
+                if not page:
+                    return None  # the node sent no bodies
+                new_chain.extend(page)
+            valid = True
+            return new_chain
+        finally:
+            if not valid:
+                new_chain.discard()
+
+    def download_headers(self, node, start, end):
+        """
+        Downloads the block headers of a node's chain, in pages of at most sync_header_page_size headers.
+
+        :param node: <str> The url of the node.
+        :param start: <int> The index of the first block.
+        :param end: <int> The index after the last block.
+        :return: <list> The headers as Block objects without transactions, None if a request failed
+                 or the node sent headers that were not requested.
+        """
+        headers = []
+        while start + len(headers) < end:
+            page_start = start + len(headers)
+            page = self.request_headers(node, page_start, min(end, page_start + sync_header_page_size))
+            if not page:
+                return None
+            for block in page:
+                if block.index != start + len(headers):
+                    return None
+                headers.append(block)
+        return headers
+
+    def find_common_ancestor(self, node, chain, length):
+        """
+        Finds the first block of our chain that is not in a node's chain.
+        The headers of the node are requested walking back from the tip of the shorter chain,
+        every time twice as many as the last time, until a block we have in common is found.
+        The node's chain can be shorter than ours and still have more work.
+
+        :param node: <str> The url of the node.
+        :param chain: <list> Our blockchain.
+        :param length: <int> The length of the node's chain.
+        :return: <int> The index of the first block that is not in both chains, None if a request failed.
+        """
+        end = min(len(chain), length)
+        start = end - 1
+        step = 1
+        while True:
+            headers = self.request_headers(node, start, end)
+            if not headers or headers[0].index != start:
+                return None
+            if headers[0].hash == chain[start].hash:
+                return start + self.find_fork(chain[start:end], headers)
+            if start == 0:
+                return 0  # not even the genesis block is the same
+            end = start
+            step *= 2
+            start = max(0, start - step)
+
+    def request_from_node(self, node, path, params=None, stream=False):
+        """
+        Sends a GET request to a node, in the binary wire format if it is enabled.
+        The request gives up if the node doesn't answer in peer_timeout secs.
+
+        :param node: <str> The url of the node.
+        :param path: <str> The route, e.g. /tip
+        :param params: <dict> The query parameters.
+        :param stream: <bool> True to read the body of the response while it is received.
+        :return: <Response> The response, None if the request failed.
+        """
+        headers = {"Accept": wire.CONTENT_TYPE} if self.binary_wire else None
+        response = requests.get('{}{}'.format(node, path), params=params, headers=headers, timeout=peer_timeout,
+                                stream=stream)
+        if response.status_code != 200:
+            response.close()
+            return None
+        return response
+
+    def request_tip(self, node):
+        """
+        Requests the length of a node's chain and the hash of its last block.
+
+        :param node: <str> The url of the node.
+        :return: <dict> {'length': the length of the chain, 'hash': the hash of the last block,
+                 'work': the cumulative work of the chain}, None if the request failed.
+        """
+        response = self.request_from_node(node, '/tip')
+        if response is None:
+            return None
+        if self.binary_wire:
+            return wire.loads(response.content)
+        return response.json()
+
+    def request_headers(self, node, start=0, end=None):
+        """
+        Requests the block headers of a node's chain.
+
+        :param node: <str> The url of the node.
+        :param start: <int> The index of the first block.
+        :param end: <int> The index after the last block, None for the tip of the chain.
+        :return: <list> A chain of Block objects without transactions, None if the request failed.
+        """
+        params = {'from': start}
+        if end is not None:
+            params['to'] = end
+
+        response = self.request_from_node(node, '/headers', params)
+        if response is None:
+            return None
+        if self.binary_wire:
+            return wire.decode_chain(response.content)
+        return self.dict_to_block_chain(response.json()['headers'])
+
+    def stream_bodies(self, node, start, end):
+        """
+        Requests a page of block bodies (the index and the transactions of every block) of a node's chain
+        and decodes the bodies while the response is received. The node may send fewer bodies than requested.
+
+        :param node: <str> The url of the node.
+        :param start: <int> The index of the first block.
+        :param end: <int> The index after the last block.
+        :return: <generator> The bodies, {'index': the block index, 'transactions': the transactions},
+                 in the order they are received.
+        """
+        params = {'from': start, 'to': min(end, start + sync_page_size)}
+        response = self.request_from_node(node, '/bodies', params, stream=True)
+        if response is None:
+            return
+        try:
+            chunks = response.iter_content(chunk_size=sync_chunk_size)
+            if self.binary_wire:
+                for item in wire.iter_unframe(chunks):
+                    yield wire.decode_body(item)
+            else:
+                for body in wire.iter_json_items(chunks):
+                    yield body
+        finally:
+            response.close()
+
+    def find_fork(self, chain, other_chain):
+        """
+        Finds the index of the first block that differs between two chains.
+
+        :param chain: <list> A blockchain
+        :param other_chain: <list> Another blockchain
+        :return: <int> The index of the first block that is not in both chains.
+        """
+        index = 0
+        while index < min(len(chain), len(other_chain)) and chain[index].hash == other_chain[index].hash:
+            index += 1
+        return index
 
     def dict_to_block_chain(self, chain):
         """
         Converts a chain of dictionaries that was received from a node
-        to a chain of Block objects.
+        to a chain of Block objects. The dictionaries can also be block headers without transactions.
 
         :param chain: <list> A chain of dictionaries
         :return: <list> A chain of Block objects
@@ -187,7 +710,7 @@ class Blockchain:
         bc = []
         for block in chain:
             timestamp = block['timestamp']
-            transactions = block['transactions']
+            transactions = block.get('transactions', [])
             previousHash = block['previousHash']
             nonce = block['nonce']
             index = block['index']
@@ -195,8 +718,10 @@ class Blockchain:
             miner = block['miner']
             signature = block['signature']
             mined_timestamp = block['mined_timestamp']
+            difficulty = block.get('difficulty', initial_difficulty)
+            merkle_root = block.get('merkle_root')
 
-            new_block = Block(index, timestamp, transactions, previousHash)
+            new_block = Block(index, timestamp, transactions, previousHash, difficulty, merkle_root)
             new_block.hash = hash
             new_block.nonce = nonce
             new_block.miner = miner
@@ -224,16 +749,7 @@ class Blockchain:
         ip_addr = ip_port_list[0]
         port = int(ip_port_list[1])
 
-        found_it = 0
-        asn_nodes_mutex.acquire()
-        for asn in ASN_nodes:
-            if ip_addr in asn and port == asn[1]:
-                found_it = 1
-                break
-        asn_nodes_mutex.release()
-
-        if not found_it:
-            ASN_nodes.append([ip_addr, port, ASN, None])
+        AS_registry.add(ip_addr, port, ASN)  # if it is not registered yet
 
     def broadcast_transaction(self, transaction):
         """
@@ -241,88 +757,249 @@ class Blockchain:
 
         :param transaction: : <Transaction>
         """
-        transaction_dict = transaction.__dict__
-        transaction_type = transaction_dict['type']
-        transaction_data = json.dumps(transaction_dict)
-        headers = {
-            "Content-Type": "application/json"
-        }
+        transaction_dict = {}
+        for key, value in transaction.__dict__.items():
+            # e.g. the Assign transaction of a Revoke/Update transaction
+            transaction_dict[key] = value.to_dict() if isinstance(value, TransactionRecord) else value
         print("Broadcasting the transaction to the rest of the network...")
+        # it is announced with the other transactions of the next relay_batch_window secs
+        self.transaction_batcher.add((transaction.calculate_hash(), transaction_dict))
+
+    def announce_transactions(self, transactions):
+        """
+        Announces a batch of transactions to the rest of the network.
+        Only the txids are sent to every neighbor, a neighbor answers with the txids it doesn't have
+        and only those transactions are sent to it (see send_missing_transactions).
+
+        :param transactions: <list> [ (txid, the transaction as a dictionary), ... ]
+        """
+        relay_mutex.acquire()
+        for txid, transaction_dict in transactions:
+            self.relay_transactions[txid] = transaction_dict
+            self.relay_transactions.move_to_end(txid)
+        while len(self.relay_transactions) > relay_cache_size:
+            self.relay_transactions.popitem(last=False)
+        relay_mutex.release()
+
+        inventory = {'txids': [txid for txid, _ in transactions], 'node': self.url}
+        inventory_data, headers = wire.encode_message(inventory, self.binary_wire)
 
         bc_nodes_mutex.acquire()
-        neighbors = self.nodes
-        for node in neighbors:
-            try:
-                if transaction_type == "Assign":
-                    requests.post('{}/transactions/assign/incoming'.format(node[0]), data=transaction_data,
-                                  headers=headers)
-                elif transaction_type == "Revoke":
-                    requests.post('{}/transactions/revoke/incoming'.format(node[0]), data=transaction_data,
-                                  headers=headers)
-                elif transaction_type == "Update":
-                    requests.post('{}/transactions/update/incoming'.format(node[0]), data=transaction_data,
-                                  headers=headers)
-                elif transaction_type == "BGP Announce":
-                    requests.post('{}/transactions/bgp_announce/incoming'.format(node[0]),
-                                  data=transaction_data, headers=headers)
-                elif transaction_type == "BGP Withdraw":
-                    requests.post('{}/transactions/bgp_withdraw/incoming'.format(node[0]),
-                                  data=transaction_data, headers=headers)
-            except:
-                print("Could not contact node {}. Moving on...".format(node[0]))
-                continue
+        neighbors = list(self.nodes)
         bc_nodes_mutex.release()
+        # the messages are sent by the outbound workers, a slow neighbor doesn't delay the others
+        self.outbound.broadcast(neighbors, 'POST', '/inventory', inventory_data, headers,
+                                self.send_missing_transactions)
+
+    def send_missing_transactions(self, node, values):
+        """
+        Sends a neighbor the announced transactions it doesn't have, in one batch.
+
+        :param node: <str> The url of the neighbor.
+        :param values: <dict> The answer of the neighbor to the announcement, {'missing': [txid, ...]}
+        """
+        transactions = self.announced_transactions(values['missing'])
+        if not transactions:
+            return
+
+        batch_data, headers = wire.encode_message({'transactions': transactions}, self.binary_wire)
+        self.outbound.send(node, 'POST', '/transactions/batch/incoming', batch_data, headers)
+
+    def announced_transactions(self, txids):
+        """
+        Finds the transactions this node announced, e.g. for a neighbor that asks for them again.
+
+        :param txids: <list> The txids of the transactions.
+        :return: <list> The transactions as dictionaries, the ones that are no longer kept are left out.
+        """
+        relay_mutex.acquire()
+        transactions = [self.relay_transactions.get(txid) for txid in txids]
+        relay_mutex.release()
+        return [transaction for transaction in transactions if transaction is not None]
+
+    def replace_chain(self, new_chain):
+        """
+        Replaces our chain with a new valid chain and updates the state.
+        The blocks of our chain after the last block in common with the new chain are rolled back with
+        their undo logs and only the new blocks are applied, so a reorg costs as much as the blocks it changes.
+        If the fork is deeper than the undo logs go, the state is rebuilt from the genesis block.
+
+        The hash of every new block is checked before our chain is changed, so a block store is never
+        truncated for a block it can't store.
+
+        :param new_chain: <list> The new blockchain
+        :return: <bool> True if our chain was replaced, False if a new block doesn't have the hash it claims.
+        """
+        fork_index = min(len(self.chain), len(new_chain))
+        while fork_index > 0 and self.chain[fork_index - 1].hash != new_chain[fork_index - 1].hash:
+            fork_index -= 1
+
+        for index in range(fork_index, len(new_chain)):
+            if new_chain[index].hash != new_chain[index].calculate_hash():
+                print("Block {} of the new chain doesn't have the hash it claims".format(index))
+                return False
+
+        if fork_index == 0 or any(index not in self.undo_logs for index in range(fork_index, self.applied_height)):
+            self.set_chain(new_chain, fork_index)
+            self.rebuild_state()
+            return True
+
+        while self.applied_height > fork_index:
+            self.rollback_block(self.chain[self.applied_height - 1])
+        self.set_chain(new_chain, fork_index)
+        self.txid_to_block_update(self.applied_height)
+        self.state_update()
+        return True
+
+    def set_chain(self, new_chain, fork_index):
+        """
+        Replaces the blocks of our chain after the fork with the blocks of the new chain.
+        The new blocks are copied one at a time, so a new chain in a temporary store is not loaded in memory.
+
+        :param new_chain: <list> The new blockchain
+        :param fork_index: <int> The index of the first block that is not in both chains.
+        """
+        if isinstance(self.chain, BlockStore):
+            self.chain.truncate(fork_index)
+        else:
+            self.chain = self.chain[:fork_index]
+        for index in range(fork_index, len(new_chain)):
+            block = new_chain[index]
+            self.chain.append(block)
+            self.serialize_block(block)
+
+    def rollback_block(self, block):
+        """
+        Undoes the changes the last applied block made to the state, the topologies and the txid_to_block dictionary.
 
-    def txid_to_block_update(self):
+        :param block: <Block> The last applied block.
+        """
+        undo_log = self.undo_logs.pop(block.index)
+
+        for prefix, prefix_state in undo_log['state'].items():
+            if prefix_state is None:
+                state.pop(prefix, None)
+            else:
+                state[prefix] = prefix_state
+
+        topo_mutex.acquire()
+        for prefix, topo in undo_log['topo'].items():
+            if topo is None:
+                AS_topo.pop(prefix, None)
+            else:
+                AS_topo[prefix] = topo
+        topo_mutex.release()
+
+        for transaction in block.transactions:
+            if txid_to_block.get(transaction.txid) == block.index:
+                del txid_to_block[transaction.txid]
+        self.applied_height -= 1
+
+    def rebuild_state(self):
+        """
+        Rebuilds the state, the topologies and the txid_to_block dictionary from the genesis block.
+        """
+        self.init_state()
+        self.undo_logs.clear()
+        self.applied_height = 1
+        self.txid_to_block_update()
+        self.state_update()
+
+    def txid_to_block_update(self, start=1):
         """
         Updates the txid_to_block dictionary after the chain has been replaced
+
+        :param start: <int> The index of the first block whose transactions are added.
         """
-        for block in self.chain:
-            index = block.index
-            for i in range(len(block.transactions)):
-                if index > 0:
-                    txid = block.transactions[i]['trans']['txid']
-                    txid_to_block[txid] = index
+        for index in range(max(start, 1), len(self.chain)):
+            for transaction in self.chain[index].transactions:
+                txid_to_block[transaction.txid] = index
 
     def state_update(self):
         """
-        Updates the state dictionary after the chain has been replaced
+        Updates the state dictionary with the blocks that were added to the chain since the last update.
+        Only the blocks after applied_height are applied, so the cost does not depend on the length of the chain.
         """
-        for block in self.chain:  # go through every block from the beginning
-            if block.index > 0:
-                for i in range(len(block.transactions)):
-                    transaction = block.transactions[i]['trans']
+        while self.applied_height < len(self.chain):
+            self.apply_block(self.chain[self.applied_height])
+            self.applied_height += 1
 
-                    if transaction['type'] == "Assign":
-                        self.update_assign(transaction)
-                        if transaction['txid'] in my_assignments:
-                            pass
-                            # self.check_revoke(transaction)
+        if self.checkpoint_path is not None and self.applied_height - self.checkpoint_height >= checkpoint_interval:
+            # only the snapshot is taken here, under the mutex, the checkpoint is encoded and written in the background
+            try:
+                snapshot = checkpoint.snapshot_checkpoint(self)
+            except Exception as e:
+                # a failed checkpoint must not stop the caller, that holds the mutex, the next update tries again
+                print("Could not take a checkpoint at height {}: {}".format(self.applied_height, e))
+                return
+            self.checkpoint_height = self.applied_height
+            self.checkpoint_writer.submit(checkpoint.write_checkpoint, snapshot, self.checkpoint_path)
+
+    def apply_block(self, block):
+        """
+        Applies the transactions of a block to the state and the topologies.
+        The state and the topology of every prefix the block changes are saved in the undo log of the block first.
+
+        :param block: <Block>
+        """
+        undo_log = {'state': {}, 'topo': {}}
+        for transaction in block.transactions:
+            prefix = self.transaction_prefix(transaction)
+            if prefix is not None and prefix not in undo_log['state']:
+                undo_log['state'][prefix] = list(state[prefix]) if prefix in state else None
+                topo_mutex.acquire()
+                undo_log['topo'][prefix] = AS_topo[prefix].copy() if prefix in AS_topo else None
+                topo_mutex.release()
+
+            if transaction.type == "Assign":
+                self.update_assign(transaction)
+                if transaction.txid in my_assignments:
+                    pass
+                    # self.check_revoke(transaction)
+
+            elif transaction.type == "Revoke":
+                self.update_revoke(transaction)
 
-                    elif transaction['type'] == "Revoke":
-                        self.update_revoke(transaction)
+            elif transaction.type == "Update":
+                self.update_update(transaction)
 
-                    elif transaction['type'] == "Update":
-                        self.update_update(transaction)
+            elif transaction.type == "BGP Announce":
+                self.update_bgp_announce(transaction)
 
-                    elif transaction['type'] == "BGP Announce":
-                        self.update_bgp_announce(transaction)
+            elif transaction.type == "BGP Withdraw":
+                self.update_bgp_withdraw(transaction)
 
-                    elif transaction['type'] == "BGP Withdraw":
-                        self.update_bgp_withdraw(transaction)
+        self.undo_logs[block.index] = undo_log
+        self.undo_logs.pop(block.index - max_undo_depth, None)  # keep only the last max_undo_depth undo logs
+
+    def transaction_prefix(self, transaction):
+        """
+        Finds the prefix whose state or topology a transaction changes.
+
+        :param transaction: <TransactionRecord>
+        :return: <str> The prefix, None if the transaction does not change any prefix.
+        """
+        if transaction.type in ("Assign", "BGP Announce", "BGP Withdraw"):
+            return transaction.prefix
+
+        if transaction.type in ("Revoke", "Update"):
+            assign_tran = self.find_by_txid(transaction.assign_txid)
+            if assign_tran is not None:
+                return assign_tran.prefix
+        return None
 
     def update_assign(self, transaction):
         """
         Updates the state for an Assign transaction
 
-        :param transaction: <dict> An assign transaction
+        :param transaction: <AssignRecord> An assign transaction
         """
-        prefix = transaction['input'][0]
-        as_source = transaction['input'][1]
-        asn_list = transaction['input'][2]
-        ld = transaction['input'][4]
-        tt = transaction['input'][5]
-        last_assign = transaction['txid']
+        prefix = transaction.prefix
+        as_source = transaction.as_source
+        asn_list = transaction.as_dest
+        ld = transaction.lease_duration
+        tt = transaction.transfer_tag
+        last_assign = transaction.txid
 
         found = 0
         for asn in asn_list:
@@ -351,19 +1028,18 @@ class Blockchain:
         """
         Updates the state for a Revoke transaction
 
-        :param transaction: <dict> A revoke transaction
+        :param transaction: <RevokeRecord> A revoke transaction
         """
-        as_source = transaction['input'][0]
-        assign_tran_id = transaction['input'][1]
-        ld = transaction['output'][0][2]
-        tt = transaction['output'][0][-1]
+        as_source = transaction.as_source
+        assign_tran_id = transaction.assign_txid
+        ld = transaction.new_lease
+        tt = transaction.transfer_tag
         assign_tran = self.find_by_txid(assign_tran_id)
 
         if assign_tran is not None:
-            tran = assign_tran['trans']
-            prefix = tran['input'][0]
-            as_dest_list = tran['input'][2]
-            last_assign = tran['input'][-1]
+            prefix = assign_tran.prefix
+            as_dest_list = assign_tran.as_dest
+            last_assign = assign_tran.last_assign
 
             for asn in as_dest_list:
                 for i in range(len(state[prefix])):
@@ -394,17 +1070,16 @@ class Blockchain:
         """
         Updates the state for an Update transaction
 
-        :param transaction: <dict> An update transaction
+        :param transaction: <UpdateRecord> An update transaction
         """
-        assign_id = transaction['input'][1]
-        new_lease = transaction['input'][2]
+        assign_id = transaction.assign_txid
+        new_lease = transaction.new_lease
         assign_tran = self.find_by_txid(assign_id)
 
         if assign_tran is not None:
 
-            tran = assign_tran['trans']
-            prefix = tran['input'][0]
-            as_dest_list = tran['input'][2]
+            prefix = assign_tran.prefix
+            as_dest_list = assign_tran.as_dest
 
             for asn in as_dest_list:
                 for i in range(len(state[prefix])):
@@ -422,8 +1097,8 @@ class Blockchain:
         """
         from Transaction import RevokeTransaction
 
-        as_source = transaction['input'][1]
-        txid = transaction['txid']
+        as_source = transaction.as_source
+        txid = transaction.txid
 
         new_revoke = RevokeTransaction(as_source, txid, time())
 
@@ -443,10 +1118,10 @@ class Blockchain:
         """
         Updates the topology of a prefix given in an Announce transaction.
 
-        :param transaction: <dict> A BGP Announce transaction
+        :param transaction: <BGPAnnounceRecord> A BGP Announce transaction
         """
-        prefix = transaction['input'][0]
-        sub_paths = transaction['output']
+        prefix = transaction.prefix
+        sub_paths = transaction.sub_paths
         topo_mutex.acquire()
         topo = AS_topo[prefix]
 
@@ -461,11 +1136,11 @@ class Blockchain:
         """
         Updates the topology of a prefix after a Withdraw transaction.
 
-        :param transaction: <dict> A BGP Withdraw transaction.
+        :param transaction: <BGPWithdrawRecord> A BGP Withdraw transaction.
         """
         redundant_nodes = set()
-        prefix = transaction['input'][0]
-        as_source = transaction['input'][1]
+        prefix = transaction.prefix
+        as_source = transaction.as_source
         topo_mutex.acquire()
         topo = AS_topo[prefix]
         # remove the edges between the withdrawing node and its predecessors.
@@ -526,7 +1201,7 @@ class Blockchain:
         """
         Finds a transaction based on a txid.
 
-        :return: <dict> the requested transaction, None if a transaction is not found.
+        :return: <TransactionRecord> the requested transaction, None if a transaction is not found.
         """
         try:
             index = txid_to_block[txid]
@@ -535,11 +1210,42 @@ class Blockchain:
             print("Txid not found")
             return None
 
-        for i in range(len(block.transactions)):
-            if txid == block.transactions[i]['trans']['txid']:
-                requested_tran = block.transactions[i]
-                return requested_tran
+        for transaction in block.transactions:
+            if txid == transaction.txid:
+                return transaction
         return None
 
+    def inclusion_proof(self, txid):
+        """
+        Creates the Merkle inclusion proof of a transaction.
+
+        :param txid: The txid of the transaction.
+        :return: <dict> The proof and the block header fields needed to check it, None if the txid is not found.
+        """
+        try:
+            index = txid_to_block[txid]
+            block = self.chain[index]
+        except (KeyError, IndexError):
+            return None
+
+        leaves = []
+        position = None
+        for i, transaction in enumerate(block.transactions):
+            leaves.append(transaction.leaf_hash())
+            if transaction.txid == txid:
+                position = i
+
+        if position is None:
+            return None
+
+        return {
+            'txid': txid,
+            'block_index': index,
+            'block_hash': block.hash,
+            'merkle_root': block.merkle_root,
+            'transaction_hash': leaves[position],
+            'proof': merkle_proof(leaves, position)
+        }
+
 
 blockchain = Blockchain()
@@ -1,5 +1,6 @@
 import hashlib
-from config import ASN_nodes, txid_to_block, state, asn_nodes_mutex
+from records import new_record
+from config import AS_registry, txid_to_block, state, signature_cache
 from Blockchain import blockchain
 
 """
@@ -40,7 +41,7 @@ class IPAllocationTransaction:
         AS_pkey = self.find_asn_public_key()
 
         if AS_pkey is not None:
-            return AS_pkey.verify(trans_hash.encode(), self.signature)
+            return signature_cache.verify(AS_pkey, trans_hash, self.signature)
         else:
             return False
 
@@ -50,14 +51,7 @@ class IPAllocationTransaction:
 
         :return: <RSA key> The public key of the node, or None if the key is not found.
         """
-        ASN_pkey = None
-        asn_nodes_mutex.acquire()
-        for asn in ASN_nodes:  # find ASN public key
-            if self.as_source == asn[2]:
-                ASN_pkey = asn[-1]
-                break
-        asn_nodes_mutex.release()
-        return ASN_pkey
+        return AS_registry.public_key(self.as_source)
 
     def calculate_hash(self):
         """
@@ -107,19 +101,11 @@ class IPAllocationTransaction:
         """
         Returns a valid transaction to be added to a block in the blockchain.
 
-        :return: <dict> A valid transaction, or None if the transaction is not valid.
+        :return: <TransactionRecord> A valid transaction, or None if the transaction is not valid.
         """
         if self.validate_transaction():
-            transaction = {
-                'trans': {
-                    'type': self.type,
-                    'input': self.get_input(),
-                    'output': self.get_output(),
-                    'timestamp': self.time,
-                    'txid': self.calculate_hash()
-                },
-                'signature': self.signature
-            }
+            transaction = new_record(self.type, self.get_input(), self.get_output(), self.time, self.calculate_hash(),
+                                     self.signature)
             return transaction
         else:
             return None
@@ -188,11 +174,7 @@ class AssignTransaction(IPAllocationTransaction):
         Checks if the destination ASes of an IP Assign transaction are in the blockchain network.
         :return: <bool> True if the ASes are in the network, False otherwise.
         """
-        ASes = []
-        asn_nodes_mutex.acquire()
-        for i in range(len(ASN_nodes)):
-            ASes.append(ASN_nodes[i][2])
-        asn_nodes_mutex.release()
+        ASes = AS_registry.asns()
 
         for AS in self.as_dest:
             if AS not in ASes:
@@ -215,7 +197,7 @@ class RevokeTransaction(IPAllocationTransaction):
         """
         if self.verify_signature(self.calculate_hash()) and self.lease_expired() and self.check_state():
 
-            prefix = self.assign_tran['trans']['input'][0]
+            prefix = self.assign_tran.prefix
             new_leaseDuration = self.calculate_new_lease()
 
             input = [self.as_source, self.assign_tran_id]
@@ -235,8 +217,8 @@ class RevokeTransaction(IPAllocationTransaction):
         :return: <bool> True if the lease is expired, False otherwise.
         """
         if self.assign_tran is not None:
-            lease = self.assign_tran['trans']['input'][4]
-            timestamp = self.assign_tran['trans']['timestamp']
+            lease = self.assign_tran.lease_duration
+            timestamp = self.assign_tran.timestamp
 
             if self.time >= timestamp + 2629743.83 * lease:  # 1 month = 2629743.83 secs
                 return True
@@ -247,15 +229,15 @@ class RevokeTransaction(IPAllocationTransaction):
         Finds the Assign transaction from the blockchain with the txid that was given
         when creating this Revoke transaction.
 
-        :return: <dict> The Assign transaction if found, None otherwise.
+        :return: <AssignRecord> The Assign transaction if found, None otherwise.
         """
         if self.assign_tran_id in txid_to_block.keys():
             index = txid_to_block[self.assign_tran_id]
             block = blockchain.chain[index]
-            for i in range(len(block.transactions)):
-                if block.transactions[i]['trans']['type'] == "Assign":
-                    if self.assign_tran_id == block.transactions[i]['trans']['txid']:
-                        return block.transactions[i]
+            for transaction in block.transactions:
+                if transaction.type == "Assign":
+                    if self.assign_tran_id == transaction.txid:
+                        return transaction
         return None
 
     def check_state(self):
@@ -267,9 +249,9 @@ class RevokeTransaction(IPAllocationTransaction):
         :return: <bool> True if correct, False otherwise.
         """
         if self.assign_tran is not None:
-            prefix = self.assign_tran['trans']['input'][0]
-            as_source = self.assign_tran['trans']['input'][1]
-            as_dest = self.assign_tran['trans']['input'][2]
+            prefix = self.assign_tran.prefix
+            as_source = self.assign_tran.as_source
+            as_dest = self.assign_tran.as_dest
 
             if self.as_source == as_source:
                 # find if all ASes in the transaction are currently the owners of the prefix(from state)
@@ -290,8 +272,8 @@ class RevokeTransaction(IPAllocationTransaction):
 
         :return: <int> The new lease period (in months).
         """
-        old_lease = self.assign_tran['trans']['input'][4]
-        my_prev_lease = self.assign_tran['trans']['input'][3]
+        old_lease = self.assign_tran.lease_duration
+        my_prev_lease = self.assign_tran.source_lease
         my_new_lease = my_prev_lease - old_lease
         return my_new_lease
 
@@ -311,9 +293,9 @@ class UpdateTransaction(IPAllocationTransaction):
         :return: <bool> True if transaction is valid, False otherwise.
         """
         if self.verify_signature(self.calculate_hash()) and not self.lease_expired() and self.check_state():
-            prefix = self.assign_tran['trans']['input'][0]
-            as_dest = self.assign_tran['trans']['input'][2]
-            transfer_tag = self.assign_tran['trans']['input'][5]
+            prefix = self.assign_tran.prefix
+            as_dest = self.assign_tran.as_dest
+            transfer_tag = self.assign_tran.transfer_tag
 
             input = [self.as_source, self.assign_tran_id, self.new_lease]
             self.set_input(input)
@@ -337,10 +319,10 @@ class UpdateTransaction(IPAllocationTransaction):
         :return: <bool> True if correct, False otherwise.
         """
         if self.assign_tran is not None:
-            prefix = self.assign_tran['trans']['input'][0]
-            as_source = self.assign_tran['trans']['input'][1]
-            as_dest = self.assign_tran['trans']['input'][2]
-            as_source_original_lease = self.assign_tran['trans']['input'][3]
+            prefix = self.assign_tran.prefix
+            as_source = self.assign_tran.as_source
+            as_dest = self.assign_tran.as_dest
+            as_source_original_lease = self.assign_tran.source_lease
             current_lease = 2000  # doesn't matter
 
             if self.new_lease > as_source_original_lease:
@@ -379,8 +361,8 @@ class UpdateTransaction(IPAllocationTransaction):
         :return: <bool> True if the lease is expired, False otherwise.
         """
         if self.assign_tran is not None:
-            lease = self.assign_tran['trans']['input'][4]
-            timestamp = self.assign_tran['trans']['timestamp']
+            lease = self.assign_tran.lease_duration
+            timestamp = self.assign_tran.timestamp
 
             if self.time >= timestamp + 2629743.83 * lease:  # 1 month = 2629743.83 secs
                 return True
@@ -401,11 +383,10 @@ class UpdateTransaction(IPAllocationTransaction):
 
         for block in chain:
             if block.index > 0:
-                for i in range(len(block.transactions)):
-                    transaction = block.transactions[i]['trans']
-                    if transaction['type'] == "Update":
-                        as_source = transaction['input'][0]
-                        lease = transaction['input'][2]
+                for transaction in block.transactions:
+                    if transaction.type == "Update":
+                        as_source = transaction.as_source
+                        lease = transaction.new_lease
                         if self.as_source == as_source:
                             all_update_lease_sum += lease
 
@@ -419,13 +400,13 @@ class UpdateTransaction(IPAllocationTransaction):
         Finds the assign transaction from the blockchain with the txid that was given
         when creating this Update transaction.
 
-        :return: <dict> The Assign transaction if found, None otherwise.
+        :return: <AssignRecord> The Assign transaction if found, None otherwise.
         """
         if self.assign_tran_id in txid_to_block.keys():
             index = txid_to_block[self.assign_tran_id]
             block = blockchain.chain[index]
-            for i in range(len(block.transactions)):
-                if block.transactions[i]['trans']['type'] == "Assign":
-                    if self.assign_tran_id == block.transactions[i]['trans']['txid']:
-                        return block.transactions[i]
+            for transaction in block.transactions:
+                if transaction.type == "Assign":
+                    if self.assign_tran_id == transaction.txid:
+                        return transaction
         return None
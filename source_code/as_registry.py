@@ -0,0 +1,122 @@
+import threading
+from collections import namedtuple
+
+"""
+The AS Registry module. Keeps the AS nodes of the network (IP address, port, ASN and public key),
+indexed by ASN and by address, so that the public key of an AS is found without scanning all the nodes.
+
+The registry is copy-on-write: a change builds new indexes and replaces the old ones in one assignment.
+Readers use the indexes they find, without a lock, and never see a half-made change.
+Changes are rare (a node joins, leaves or sends its key) while lookups happen for every signature check.
+"""
+
+ASNode = namedtuple('ASNode', ['ip', 'port', 'asn', 'public_key'])
+
+
+class RegistrySnapshot:
+    """
+    The nodes of the registry at one point in time and their indexes. A snapshot is never changed.
+    """
+
+    def __init__(self, nodes):
+        """
+        :param nodes: <tuple> The ASNode objects, in the order they were registered.
+        """
+        self.nodes = nodes
+        self.by_address = {}  # { (ip, port) : ASNode }
+        self.by_asn = {}  # { ASN : the first registered ASNode of the AS }
+        for node in nodes:
+            self.by_address[(node.ip, node.port)] = node
+            self.by_asn.setdefault(node.asn, node)
+        self.asns = frozenset(self.by_asn)
+
+
+class ASRegistry:
+    """
+    The AS nodes of the network. It can be iterated like the list of the nodes.
+    """
+
+    def __init__(self):
+        self.snapshot = RegistrySnapshot(())
+        self.lock = threading.Lock()  # only for the changes, one at a time
+
+    def __iter__(self):
+        return iter(self.snapshot.nodes)
+
+    def __len__(self):
+        return len(self.snapshot.nodes)
+
+    def __repr__(self):
+        return 'ASRegistry({!r})'.format(list(self.snapshot.nodes))
+
+    def find(self, ip, port):
+        """
+        Finds the node with the given address.
+
+        :param ip: <str> The IP address of the node.
+        :param port: <int> The port of the node.
+        :return: <ASNode> The node, None if it is not registered.
+        """
+        return self.snapshot.by_address.get((ip, port))
+
+    def public_key(self, asn):
+        """
+        Finds the public key of an AS.
+
+        :param asn: <str> The AS number.
+        :return: <RSA key> The public key of the AS, None if the AS or its key is not known.
+        """
+        node = self.snapshot.by_asn.get(asn)
+        return node.public_key if node is not None else None
+
+    def asns(self):
+        """
+        :return: <frozenset> The AS numbers of all the nodes.
+        """
+        return self.snapshot.asns
+
+    def add(self, ip, port, asn, public_key=None):
+        """
+        Registers a node, if no node with the same address is registered.
+
+        :return: <bool> True if the node was added, False if the address was already registered.
+        """
+        self.lock.acquire()
+        try:
+            if (ip, port) in self.snapshot.by_address:
+                return False
+            self.snapshot = RegistrySnapshot(self.snapshot.nodes + (ASNode(ip, port, asn, public_key),))
+            return True
+        finally:
+            self.lock.release()
+
+    def set_public_key(self, ip, port, public_key):
+        """
+        Changes the public key of the node with the given address.
+
+        :return: <bool> True if the key was changed, False if the node is not registered.
+        """
+        self.lock.acquire()
+        try:
+            old = self.snapshot.by_address.get((ip, port))
+            if old is None:
+                return False
+            nodes = tuple(node._replace(public_key=public_key) if node is old else node
+                          for node in self.snapshot.nodes)
+            self.snapshot = RegistrySnapshot(nodes)
+            return True
+        finally:
+            self.lock.release()
+
+    def remove(self, ip, port):
+        """
+        Removes the node with the given address, e.g. a neighbor that left the network,
+        so that it can be registered again if it rejoins.
+        """
+        self.lock.acquire()
+        try:
+            old = self.snapshot.by_address.get((ip, port))
+            if old is not None:
+                self.snapshot = RegistrySnapshot(tuple(node for node in self.snapshot.nodes if node is not old))
+        finally:
+            self.lock.release()
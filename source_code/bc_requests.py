@@ -1,4 +1,6 @@
 import csv, requests, json
+from merkle import verify_proof, transaction_hash
+from Block import Block
 
 """
 This module provides functions that request data from the blockchain.
@@ -85,4 +87,100 @@ def get_by_txid(txid):
         except:
             print("Could not contact node {}:{}. Moving on...".format(node[0], node[1]))
             continue
-    return None
\ No newline at end of file
+    return None
+
+
+def get_headers():
+    """
+    Asks the BC network for the headers of the blocks of the chain, e.g. to check inclusion proofs against them.
+    A node whose headers are not a valid chain (see download_headers) is skipped and the next node is asked.
+
+    :return: <dict> { block index : block header }, None if no node sent valid headers or the nodes can't be reached.
+    """
+    net_list = get_network()
+    for node in net_list:
+        try:
+            headers = download_headers(node)
+        except:
+            print("Could not contact node {}:{}. Moving on...".format(node[0], node[1]))
+            continue
+        if headers is None:
+            print("Node {}:{} sent invalid headers. Moving on...".format(node[0], node[1]))
+            continue
+        return {header['index']: header for header in headers}
+    return None
+
+
+def download_headers(node):
+    """
+    Downloads the headers of the chain of a node. A node sends a page of headers at a time
+    (at most sync_header_page_size), the next page is requested until the node sends an empty one.
+    Every header must have the hash it claims, point to the hash of the header before it and,
+    after the genesis block, have the Proof of Work of its difficulty.
+
+    :param node: [IP, port] of the node.
+    :return: <list> The block headers, None if they are not a valid chain.
+    """
+    headers = []
+    last_hash = None
+    while True:
+        response = requests.get('http://{}:{}/headers'.format(node[0], node[1]), params={'from': len(headers)})
+        page = response.json()['headers']
+        if not page:
+            return headers
+        for header in page:
+            block = Block(header['index'], header['timestamp'], [], header['previousHash'], header['difficulty'],
+                          header['merkle_root'])
+            block.nonce = header['nonce']
+            block_hash = block.calculate_hash()
+            if header['index'] != len(headers) or header['hash'] != block_hash:
+                return None
+            if headers and (header['previousHash'] != last_hash
+                            or block_hash[:block.difficulty] != "0" * block.difficulty):
+                return None
+            headers.append(header)
+            last_hash = block_hash
+
+
+def get_inclusion_proof(txid, block_headers, transaction=None):
+    """
+    Asks the BC network for the Merkle inclusion proof of a transaction and checks it against a block header
+    that the caller already holds, not against the Merkle root in the response.
+    A node whose proof is not valid is skipped and the next node is asked.
+
+    :param txid: The txid of the transaction.
+    :param block_headers: <dict> { block index : block header }, e.g. from get_headers.
+    :param transaction: <dict> The transaction (as in a block of the chain), if the caller has it.
+                        The proof must then be for this transaction.
+    :return: <dict> the proof if it is valid, None if no node sent a valid proof or if the nodes can't be reached.
+    """
+    headers = {
+        "Content-Type": "application/json"
+    }
+
+    net_list = get_network()
+    req = {
+        "txid": txid,
+    }
+    req_data = json.dumps(req)
+
+    for node in net_list:
+        try:
+            response = requests.post('http://{}:{}/transactions/proof'.format(node[0], node[1]), data=req_data,
+                                     headers=headers)
+            proof = response.json()
+            header = block_headers.get(proof['block_index'])
+        except:
+            print("Could not contact node {}:{}. Moving on...".format(node[0], node[1]))
+            continue
+        if header is None or header['hash'] != proof['block_hash']:
+            print("Node {}:{} sent a proof for an unknown block. Moving on...".format(node[0], node[1]))
+            continue
+        if transaction is not None and (transaction['trans']['txid'] != txid
+                                        or transaction_hash(transaction) != proof['transaction_hash']):
+            print("Node {}:{} sent a proof for another transaction. Moving on...".format(node[0], node[1]))
+            continue
+        if verify_proof(proof['transaction_hash'], proof['proof'], header['merkle_root']):
+            return proof
+        print("Node {}:{} sent an invalid proof. Moving on...".format(node[0], node[1]))
+    return None
@@ -0,0 +1,331 @@
+import json
+import hashlib
+import platform
+from itertools import cycle
+import networkx as nx
+from time import time, perf_counter
+from argparse import ArgumentParser
+from config import AS_registry, AS_topo, txid_to_block, node_key, target_block_time, signature_cache
+from Blockchain import blockchain
+from Block import Block
+from Transaction import AssignTransaction, RevokeTransaction, UpdateTransaction
+from BGP_Transaction import BGP_Announce, BGP_Withdraw
+from records import new_record
+from miner import search_nonce
+
+"""
+Micro-benchmarks for the hot paths of a node. They run offline, on a chain that starts from the node's genesis block.
+
+The results can be stored as JSON, so that two versions of the code can be compared:
+    $ python3 benchmark.py -o before.json
+    $ python3 benchmark.py -o after.json -c before.json
+"""
+
+ASSIGN_PREFIX = '1.0.0.0/24'  # owned by AS 13335 in the genesis block
+ASSIGN_SOURCE = '13335'
+ASSIGN_DEST = ['133741', '133948']
+BGP_PREFIX = '1.0.4.0/22'  # owned by AS 56203 in the genesis block
+BGP_ORIGIN = '56203'
+BGP_NEIGHBOR = '13335'
+TOPO_PREFIX = '10.0.0.0/8'  # a synthetic prefix for the topology benchmarks
+BENCH_MINER = 'bench'  # the miner of the blocks of the benchmark chain
+
+
+def measure(func, repeat, number, setup=None):
+    """
+    Calls a function number times per run, for repeat runs.
+    The setup function (if any) is called before every call and is not timed. Its result is passed to func.
+
+    :return: <dict> The best and the mean time per call (in seconds) of all the runs.
+    """
+    times = []
+    for _ in range(repeat):
+        total = 0.0
+        for _ in range(number):
+            args = setup() if setup is not None else ()
+            start = perf_counter()
+            func(*args)
+            total += perf_counter() - start
+        times.append(total / number)
+    best = min(times)
+    return {
+        'best': best,
+        'mean': sum(times) / len(times),
+        'ops_per_sec': 1 / best if best > 0 else 0.0,
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def signed(transaction):
+    """
+    Signs a transaction with the node's key.
+    """
+    transaction.sign(node_key.sign(transaction.calculate_hash().encode(), ''))
+    return transaction
+
+
+def new_block(transactions):
+    """
+    Mines a new block with the given transactions on top of the chain, without adding it to the chain.
+    """
+    index = len(blockchain.chain)
+    last_block = blockchain.get_last_block()
+    # target_block_time after the last block, so that the difficulty of a long benchmark chain does not go up
+    block = Block(index, last_block.timestamp + target_block_time, transactions, last_block.hash,
+                  blockchain.next_difficulty(blockchain.chain, index))
+    block.proof_of_work()
+    block.mined_timestamp = time()
+    block.sign(node_key.sign(block.calculate_hash().encode(), ''))
+    block.mined_by(BENCH_MINER)
+    return block
+
+
+def mine_block(transactions):
+    """
+    Mines a block with the given transactions on top of the chain and updates the state.
+    """
+    block = new_block(transactions)
+    blockchain.add_block(block)
+    for transaction in transactions:
+        txid_to_block[transaction.txid] = block.index
+    blockchain.state_update()
+
+
+def prepare_network():
+    """
+    All the ASes of the benchmarks sign with the node's key.
+    """
+    known = AS_registry.asns()
+    for port, asn in enumerate([ASSIGN_SOURCE, BGP_ORIGIN, BENCH_MINER] + ASSIGN_DEST):
+        if asn not in known:
+            AS_registry.add('localhost', port, asn)
+    for node in AS_registry:
+        AS_registry.set_public_key(node.ip, node.port, node_key.publickey())
+
+
+def topology_template(width):
+    """
+    A topology where width ASes learn the prefix from the origin AS, and width other ASes learn it from each of them.
+
+    :return: <DiGraph>
+    """
+    topo = nx.DiGraph()
+    topo.add_edge('origin', TOPO_PREFIX)
+    for i in range(width):
+        topo.add_edge('t{}'.format(i), 'origin')
+        for j in range(width):
+            topo.add_edge('s{}_{}'.format(i, j), 't{}'.format(i))
+    return topo
+
+
+""" ----------------------------------------------------Benchmarks---------------------------------------------------- """
+
+
+def bench_block_hashing(results, args):
+    block = Block(1, time(), [], hashlib.sha256(b'previous block').hexdigest())
+    results['block.calculate_hash'] = measure(block.calculate_hash, args.repeat, 10000)
+
+    def legacy_search():
+        # the original loop of Block.proof_of_work: format, encode and hash the whole header for every nonce.
+        for nonce in range(args.nonces):
+            block_str = '{}{}{}{}'.format(block.timestamp, block.previousHash, block.merkle_root, nonce).encode()
+            block_hash = hashlib.sha256(block_str).hexdigest()
+            if block_hash[:4] == "zzzz":  # never true, so that every nonce is hashed
+                return nonce
+
+    def kernel_search():
+        # a target that can't be met, so that every nonce is hashed.
+        search_nonce(block.header_prefix(), 0, args.nonces, 1, 64)
+
+    results['pow.legacy_loop[{} nonces]'.format(args.nonces)] = measure(legacy_search, args.repeat, 1)
+    results['pow.search_kernel[{} nonces]'.format(args.nonces)] = measure(kernel_search, args.repeat, 1)
+
+
+def bench_proof_of_work(results, args):
+    for difficulty in args.difficulties:
+        # fixed timestamps, so that every run mines the same blocks
+        timestamps = [1550660393.780062 + i for i in range(args.blocks)]
+        calls = iter(timestamps * args.repeat)
+
+        def new_block():
+            return Block(1, next(calls), [], '0' * 64, difficulty),
+
+        results['block.proof_of_work[difficulty={}]'.format(difficulty)] = \
+            measure(lambda block: block.proof_of_work(), args.repeat, len(timestamps), new_block)
+
+
+def bench_transactions(results, args):
+    """
+    Validates a transaction of every class. Every call validates a new transaction object,
+    because validate_transaction sets the input and the output of the transaction.
+    """
+    def assign():
+        return signed(AssignTransaction(ASSIGN_PREFIX, ASSIGN_SOURCE, list(ASSIGN_DEST), 1000, 2, True, time(), -1)),
+
+    results['transaction.assign'] = measure(lambda t: t.validate_transaction(), args.repeat, args.number, assign)
+
+    # the Assign transaction is mined, so that it can be updated and revoked
+    transaction = assign()[0]
+    transaction.validate_transaction()
+    assign_record = transaction.return_transaction()
+    mine_block([assign_record])
+    expired = assign_record.timestamp + 2629743.83 * 3  # the lease of 2 months has expired 3 months later
+
+    def update():
+        return signed(UpdateTransaction(ASSIGN_SOURCE, assign_record.txid, time(), 4)),
+
+    def revoke():
+        return signed(RevokeTransaction(ASSIGN_SOURCE, assign_record.txid, expired)),
+
+    def announce():
+        return signed(BGP_Announce(BGP_PREFIX, time(), BGP_ORIGIN, ['0'], [BGP_NEIGHBOR], time())),
+
+    def withdraw():
+        return signed(BGP_Withdraw(BGP_PREFIX, BGP_ORIGIN, time())),
+
+    for name, setup in [('update', update), ('revoke', revoke), ('bgp_announce', announce),
+                        ('bgp_withdraw', withdraw)]:
+        if not setup()[0].validate_transaction():
+            print("Warning: the {} benchmark validates an invalid transaction".format(name))
+        results['transaction.' + name] = measure(lambda t: t.validate_transaction(), args.repeat, args.number, setup)
+
+
+def bench_chain(results, args):
+    """
+    Mines a chain of BGP Announce blocks, then applies its last block, switches its last block with a competing one,
+    rebuilds its state and validates it, without and with the validation caches.
+    """
+    while len(blockchain.chain) < args.blocks:
+        announce = signed(BGP_Announce(BGP_PREFIX, time(), BGP_ORIGIN, ['0'], [BGP_NEIGHBOR], time()))
+        announce.validate_transaction()
+        mine_block([announce.return_transaction()])
+
+    def unapplied_block():
+        # the BGP Announce blocks can be applied again, they add the same edges to the topology
+        blockchain.applied_height -= 1
+        return ()
+
+    # a competing chain of the same length, that replaces the last block with a BGP Withdraw block
+    main_chain = list(blockchain.chain)
+    withdraw = signed(BGP_Withdraw(BGP_PREFIX, BGP_ORIGIN, time()))
+    withdraw.validate_transaction()
+    blockchain.chain = main_chain[:-1]
+    fork_chain = main_chain[:-1] + [new_block([withdraw.return_transaction()])]
+    blockchain.chain = main_chain
+    chains = cycle([fork_chain, main_chain])
+
+    length = len(blockchain.chain)
+    results['blockchain.state_update[1 new block]'] = \
+        measure(blockchain.state_update, args.repeat, args.number, unapplied_block)
+    results['blockchain.replace_chain[1 block reorg]'] = \
+        measure(lambda: blockchain.replace_chain(next(chains)), args.repeat, args.number)
+    blockchain.replace_chain(main_chain)
+    results['blockchain.rebuild_state[{} blocks]'.format(length)] = measure(blockchain.rebuild_state, args.repeat, 1)
+
+    def uncached_chain():
+        # the headers and the signatures of the chain were validated when it was mined, forget them
+        blockchain.validated_headers.clear()
+        signature_cache.entries.clear()
+        return ()
+
+    results['blockchain.valid_chain[{} blocks]'.format(length)] = \
+        measure(lambda: blockchain.valid_chain(blockchain.chain), args.repeat, 1, uncached_chain)
+    results['blockchain.valid_chain[{} blocks, cached]'.format(length)] = \
+        measure(lambda: blockchain.valid_chain(blockchain.chain), args.repeat, 1)
+
+
+def bench_topology(results, args):
+    template = topology_template(args.width)
+
+    def fresh_topology():
+        AS_topo[TOPO_PREFIX] = template.copy()
+        return ()
+
+    # path: (prefix, AS source, advertising AS, AS destination)
+    sub_paths = [(TOPO_PREFIX, 't{}'.format(i), 's{}_0'.format(i), 'n{}'.format(i)) for i in range(args.width)]
+    announce = new_record("BGP Announce", [TOPO_PREFIX, 's0_0', [], [], None], sub_paths, time(), 'announce', None)
+    withdraw = new_record("BGP Withdraw", [TOPO_PREFIX, 't0', None], [], time(), 'withdraw', None)
+
+    size = '[{} ASes]'.format(template.number_of_nodes() - 1)
+    results['topology.update_bgp_announce' + size] = \
+        measure(lambda: blockchain.update_bgp_announce(announce), args.repeat, args.number, fresh_topology)
+    results['topology.update_bgp_withdraw' + size] = \
+        measure(lambda: blockchain.update_bgp_withdraw(withdraw), args.repeat, args.number, fresh_topology)
+    results['topology.clear_topology' + size] = \
+        measure(lambda: blockchain.clear_topology(AS_topo[TOPO_PREFIX], TOPO_PREFIX, 'origin'), args.repeat,
+                args.number, fresh_topology)
+    del AS_topo[TOPO_PREFIX]
+
+
+BENCHMARKS = [bench_block_hashing, bench_proof_of_work, bench_transactions, bench_chain, bench_topology]
+
+
+""" ------------------------------------------------------------------------------------------------------------------ """
+
+
+def compare(results, baseline_file, threshold):
+    """
+    Prints the speedup of every benchmark over a previous run and marks the regressions.
+
+    :param threshold: <float> How many times slower a benchmark must be to count as a regression.
+    :return: <bool> True if there is a regression, False otherwise.
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)['results']
+
+    regression = False
+    print("{:<50} {:>12} {:>12} {:>9}".format("Benchmark", "Before (ms)", "After (ms)", "Speedup"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['best']
+        after = result['best']
+        speedup = before / after if after > 0 else float('inf')
+        mark = ''
+        if after > before * threshold:
+            mark = '  <-- regression'
+            regression = True
+        print("{:<50} {:>12.3f} {:>12.3f} {:>8.2f}x{}".format(name, before * 1000, after * 1000, speedup, mark))
+    return regression
+
+
+def main(args):
+    prepare_network()
+    results = {}
+    for benchmark in BENCHMARKS:
+        print("Running", benchmark.__name__[len('bench_'):])
+        benchmark(results, args)
+
+    if args.output is not None:
+        report = {
+            'timestamp': time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        return compare(results, args.compare, args.threshold)
+
+    print("{:<50} {:>12} {:>14}".format("Benchmark", "Best (ms)", "Ops/sec"))
+    for name, result in results.items():
+        print("{:<50} {:>12.3f} {:>14.1f}".format(name, result['best'] * 1000, result['ops_per_sec']))
+    return False
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('-o', '--output', default=None, help='JSON file to store the results in')
+    parser.add_argument('-c', '--compare', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('-t', '--threshold', default=1.1, type=float, help='slowdown that counts as a regression')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='number of runs of every benchmark')
+    parser.add_argument('-n', '--number', default=20, type=int, help='calls per run of the validation benchmarks')
+    parser.add_argument('--nonces', default=200000, type=int, help='nonces per run of the nonce search benchmarks')
+    parser.add_argument('--difficulties', default=[2, 3, 4], type=int, nargs='+', help='Proof of Work difficulties')
+    parser.add_argument('--blocks', default=20, type=int, help='length of the benchmark chain')
+    parser.add_argument('--width', default=10, type=int, help='width of the synthetic topology')
+    args = parser.parse_args()
+    exit(1 if main(args) else 0)
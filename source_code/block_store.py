@@ -0,0 +1,313 @@
+import os
+import mmap
+import shutil
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+import wire
+
+"""
+The Block Store module. Stores the blocks of the chain on disk instead of keeping them all in memory.
+
+The blocks are appended to a segment file in the binary wire format. An index file has a fixed-width record
+for every block: the offset and the length of the block in the segment file and the hash of the block.
+The index file is memory-mapped, so a block is found by its index without reading the others.
+Only the last decoded blocks are kept in memory.
+"""
+
+INDEX_RECORD = struct.Struct('>QI32s')  # offset, length, hash of the block
+
+
+class BlockStoreError(Exception):
+    """
+    Raised when the store is used after its chain changed, e.g. by a view of the old chain.
+    """
+    pass
+
+
+class BlockStore:
+    """
+    A chain of blocks stored on disk. It can be used like the list of blocks of a chain:
+    len(store), store[index], store[start:end], iteration and append.
+    """
+
+    def __init__(self, path, cache_size=1000, durable=True):
+        """
+        Opens the store, or creates it if it doesn't exist.
+
+        :param path: <str> The path of the store, the files are path.blocks and path.index
+        :param cache_size: <int> The number of decoded blocks that are kept in memory.
+        :param durable: <bool> Whether every appended block is synced to the disk,
+                        False for a temporary store that is not needed after a crash.
+        """
+        self.path = path
+        self.durable = durable
+        self.segment_path = path + '.blocks'
+        self.index_path = path + '.index'
+        self.segment = open(self.segment_path, 'a+b')
+        self.index = open(self.index_path, 'a+b')
+        self.index_map = None
+        self.length = 0
+        self.generation = 0  # changes every time blocks are removed from the end of the chain
+        self.cache = OrderedDict()  # { block index : Block }, the last used blocks
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.recover()
+
+    def recover(self):
+        """
+        Drops what a crash in the middle of an append left behind,
+        i.e. a partial index record or blocks that are not in the index.
+        """
+        index_size = os.path.getsize(self.index_path)
+        self.length = index_size // INDEX_RECORD.size
+        segment_size = os.path.getsize(self.segment_path)
+        while self.length > 0:
+            offset, length, _ = self.read_index(self.length - 1)
+            if offset + length <= segment_size:
+                break
+            self.length -= 1  # the block of this record was not written
+        self.truncate_files()
+
+    def read_index(self, index):
+        """
+        Reads the index record of a block.
+
+        :return: <tuple> The offset and the length of the block in the segment file and the hash of the block.
+        """
+        end = (index + 1) * INDEX_RECORD.size
+        if self.index_map is None or len(self.index_map) < end:
+            self.remap()
+        return INDEX_RECORD.unpack_from(self.index_map, index * INDEX_RECORD.size)
+
+    def remap(self):
+        """
+        Maps the index file to memory again, after it grew.
+        """
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+        self.index.flush()
+        if os.path.getsize(self.index_path) > 0:
+            self.index_map = mmap.mmap(self.index.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def truncate_files(self):
+        """
+        Truncates the index and the segment file to the first self.length blocks.
+        """
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+        segment_end = 0
+        if self.length > 0:
+            offset, length, _ = self.read_index(self.length - 1)
+            segment_end = offset + length
+            self.index_map.close()
+            self.index_map = None
+        self.index.truncate(self.length * INDEX_RECORD.size)
+        self.segment.truncate(segment_end)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self.get(index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.get(index) for index in range(*key.indices(self.length))]
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("Block index out of range")
+        return self.get(key)
+
+    def get(self, index):
+        """
+        Returns a block of the chain, from the cache or from the disk.
+
+        :param index: <int> The index of the block.
+        :return: <Block>
+        """
+        self.lock.acquire()
+        try:
+            block = self.cache.get(index)
+            if block is not None:
+                self.cache.move_to_end(index)
+                return block
+
+            offset, length, _ = self.read_index(index)
+            block = wire.decode_block(os.pread(self.segment.fileno(), length, offset))
+            self.cache_block(index, block)
+            return block
+        finally:
+            self.lock.release()
+
+    def cache_block(self, index, block):
+        """
+        Keeps a decoded block in memory, the least recently used block is dropped if the cache is full.
+        """
+        self.cache[index] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def append(self, block):
+        """
+        Appends a block to the end of the chain.
+        The block is written to the segment file before its index record, so a crash never leaves
+        an index record without its block.
+
+        :param block: <Block>
+        """
+        data = wire.encode_block(block)
+        block_hash = bytes.fromhex(block.hash)  # raises ValueError before anything is written
+        self.lock.acquire()
+        try:
+            self.segment.seek(0, os.SEEK_END)
+            offset = self.segment.tell()
+            self.segment.write(data)
+            self.segment.flush()
+            if self.durable:
+                os.fsync(self.segment.fileno())
+
+            self.index.write(INDEX_RECORD.pack(offset, len(data), block_hash))
+            self.index.flush()
+            if self.durable:
+                os.fsync(self.index.fileno())
+
+            self.cache_block(self.length, block)
+            self.length += 1
+        finally:
+            self.lock.release()
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def truncate(self, length):
+        """
+        Removes the blocks after the first length blocks, e.g. when the end of the chain is replaced.
+
+        :param length: <int> The number of blocks to keep.
+        """
+        self.lock.acquire()
+        try:
+            for index in range(length, self.length):
+                self.cache.pop(index, None)
+            self.length = min(length, self.length)
+            self.truncate_files()
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def view(self):
+        """
+        Returns a read-only view of the chain as it is now.
+
+        :return: <StoreView>
+        """
+        return StoreView(self, self.length)
+
+    def close(self):
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+        self.segment.close()
+        self.index.close()
+
+
+class StoreView:
+    """
+    A read-only view of the first blocks of a store. Blocks appended to the store later are not in the view.
+    The view can't be used after blocks are removed from the store.
+    """
+
+    def __init__(self, store, length):
+        self.store = store
+        self.length = length
+        self.generation = store.generation
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __getitem__(self, key):
+        if self.generation != self.store.generation:
+            raise BlockStoreError("The chain of the store has changed")
+        if isinstance(key, slice):
+            return [self.store.get(index) for index in range(*key.indices(self.length))]
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("Block index out of range")
+        return self.store.get(key)
+
+
+class ForkedChain:
+    """
+    A chain made of the first blocks of another chain (a list, a store or a view)
+    and of new blocks after them, e.g. a chain that is being downloaded from a neighbor.
+    The new blocks are kept in memory, or spilled to a temporary block store next to the store of the other chain,
+    so that a long download (e.g. from a node whose chain forks at the genesis block) doesn't have to fit in memory.
+    """
+
+    def __init__(self, base, fork_index, spill=False, cache_size=1000):
+        """
+        :param base: <list> The chain the new blocks fork from.
+        :param fork_index: <int> The index of the first new block.
+        :param spill: <bool> True to write the new blocks to a temporary store if the base chain is a store view.
+        :param cache_size: <int> The number of new blocks the temporary store keeps decoded in memory.
+        """
+        self.base = base
+        self.fork_index = fork_index
+        self.spill_directory = None
+        if spill and isinstance(base, StoreView):
+            store_directory = os.path.dirname(os.path.abspath(base.store.path))
+            self.spill_directory = tempfile.mkdtemp(prefix='fork-', dir=store_directory)
+            self.blocks = BlockStore(os.path.join(self.spill_directory, 'chain'), cache_size, durable=False)
+        else:
+            self.blocks = []  # the blocks after the fork
+
+    def __len__(self):
+        return self.fork_index + len(self.blocks)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[index] for index in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("Block index out of range")
+        if key < self.fork_index:
+            return self.base[key]
+        return self.blocks[key - self.fork_index]
+
+    def extend(self, blocks):
+        self.blocks.extend(blocks)
+
+    def is_stale(self):
+        """
+        Checks if the blocks before the fork were removed from the store of the base chain,
+        e.g. by a reorg that happened while the new blocks were downloaded.
+
+        :return: <bool> True if the chain can't be used any more, False otherwise.
+        """
+        return isinstance(self.base, StoreView) and self.base.generation != self.base.store.generation
+
+    def discard(self):
+        """
+        Removes the temporary store of the new blocks, if there is one. The chain can't be used afterwards.
+        """
+        if self.spill_directory is not None:
+            self.blocks.close()
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+            self.spill_directory = None
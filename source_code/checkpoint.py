@@ -0,0 +1,143 @@
+import os
+import hashlib
+import networkx as nx
+import wire
+from block_store import BlockStore
+from config import state, AS_topo, txid_to_block, topo_mutex
+
+"""
+The Checkpoint module. Stores the chain and the state derived from it on disk, so that a restarted node
+doesn't have to rebuild everything from the genesis block.
+
+A checkpoint file is the version byte, the SHA-256 hash of the content and the content in the binary wire format.
+The content is the height up to which the blocks of the chain are applied, the hash of the block at that height
+and the state, the topologies and the txid_to_block dictionary at that height. A node without a block store also
+stores its chain in the checkpoint. The blocks after the height are replayed when the checkpoint is loaded.
+"""
+
+HASH_SIZE = 32
+
+
+class CheckpointError(Exception):
+    """
+    Raised when a checkpoint file is corrupted.
+    """
+    pass
+
+
+def snapshot_checkpoint(blockchain):
+    """
+    Copies the chain and the state that go into a checkpoint.
+    The caller must hold the mutex, so that the chain and the state don't change while they are copied.
+    The topologies are copied under topo_mutex, the BGP transactions that arrive change them without the mutex.
+    Only the containers are copied, the snapshot is encoded and written by write_checkpoint without the mutex.
+
+    :param blockchain: <Blockchain>
+    :return: <dict> The content of the checkpoint, before it is encoded.
+    """
+    topologies = {}
+    topo_mutex.acquire()
+    try:
+        for prefix, topo in AS_topo.items():
+            topologies[prefix] = [list(topo.nodes), list(topo.edges)]
+    finally:
+        topo_mutex.release()
+
+    chain = blockchain.chain
+    return {
+        'height': blockchain.applied_height,
+        'hash': chain[blockchain.applied_height - 1].hash,
+        'chain': None if isinstance(chain, BlockStore) else list(chain),  # a store is already on disk
+        'state': {prefix: list(prefix_state) for prefix, prefix_state in state.items()},
+        'topologies': topologies,
+        'txid_to_block': dict(txid_to_block)
+    }
+
+
+def write_checkpoint(snapshot, path):
+    """
+    Stores a snapshot of the chain and the state to a checkpoint file.
+    The file is replaced atomically, so a crash while saving leaves the previous checkpoint.
+
+    :param snapshot: <dict> The content of the checkpoint, as returned by snapshot_checkpoint.
+    :param path: <str> The path of the checkpoint file.
+    """
+    chain = snapshot['chain']
+    content = wire.dumps(dict(snapshot, chain=None if chain is None else wire.encode_chain(chain)))
+
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes([wire.VERSION]))
+            f.write(hashlib.sha256(content).digest())
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("Could not store the checkpoint {}: {}".format(path, e))
+
+
+def read_checkpoint(path):
+    """
+    Reads a checkpoint file and checks the hash of its content.
+
+    :param path: <str> The path of the checkpoint file.
+    :return: <dict> The content of the checkpoint.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    wire.check_version(data)
+    content_hash = data[1:1 + HASH_SIZE]
+    content = data[1 + HASH_SIZE:]
+    if hashlib.sha256(content).digest() != content_hash:
+        raise CheckpointError("The content of the checkpoint does not match its hash")
+    return wire.loads(content)
+
+
+def load_checkpoint(blockchain, path):
+    """
+    Restores the chain and the state of a node from a checkpoint file
+    and replays the blocks of the chain after the height of the checkpoint.
+
+    :param blockchain: <Blockchain>
+    :param path: <str> The path of the checkpoint file.
+    :return: <bool> True if the checkpoint was loaded, False if it doesn't exist or it is corrupted.
+    """
+    if not os.path.exists(path):
+        return False
+    try:
+        checkpoint = read_checkpoint(path)
+    except (CheckpointError, wire.WireError) as e:
+        print("Could not load the checkpoint {}: {}".format(path, e))
+        return False
+
+    height = checkpoint['height']
+    chain = blockchain.chain
+    if checkpoint['chain'] is not None and not isinstance(chain, BlockStore):
+        chain = wire.decode_chain(checkpoint['chain'])
+    if len(chain) < height or chain[height - 1].hash != checkpoint['hash']:
+        print("The checkpoint {} is not a checkpoint of the chain".format(path))
+        return False
+    blockchain.chain = chain
+
+    # the dictionaries are updated in place, every module holds a reference to them
+    state.clear()
+    state.update(checkpoint['state'])
+    AS_topo.clear()
+    for prefix, (nodes, edges) in checkpoint['topologies'].items():
+        topo = nx.DiGraph()
+        topo.add_nodes_from(nodes)
+        topo.add_edges_from(edges)
+        AS_topo[prefix] = topo
+    txid_to_block.clear()
+    txid_to_block.update(checkpoint['txid_to_block'])
+
+    blockchain.undo_logs.clear()
+    blockchain.applied_height = height
+    blockchain.checkpoint_height = height
+    blockchain.txid_to_block_update(height)
+    blockchain.state_update()
+    print("Loaded the checkpoint at height {}, {} blocks replayed".format(height, len(blockchain.chain) - height))
+    return True
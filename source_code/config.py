@@ -1,16 +1,19 @@
 import threading
 import csv
+from collections import OrderedDict
 import sys
 sys.path.append('../caida_utils')
 from parse_utils import get_as_prefs
 from Crypto.PublicKey import RSA
 from Crypto import Random
+from as_registry import ASRegistry
+from sig_cache import SignatureCache
 
 """
 The global variables and structures all other modules should be able to see
 """
 
-ASN_nodes = []  # ASN nodes = [ [IP Address, Port, ASN, ASN Public Key] ]
+AS_registry = ASRegistry()  # the AS nodes of the network, ASNode(IP Address, Port, ASN, ASN Public Key)
 
 # IP Allocation state and Graph per prefix state
 state = {}  # state: {'prefix' : [ (AS1, lease duration(in months), transfer tag, txid), ... ,
@@ -36,19 +39,30 @@ assign_txids = set()
 
 alive_neighbors = {}  # { 'url of neighbor' : time_received }
 
+requested_txids = OrderedDict()  # { txid : the time it was asked for }, the announced transactions a node asked for
+txid_announcers = {}  # { txid : [url of a neighbor, ...] }, the other neighbors that announced a requested transaction
+
 # different mutexes for some critical sections
-asn_nodes_mutex = threading.Lock()
 bc_nodes_mutex = threading.Lock()
 mutex = threading.Lock()
 pt_mutex = threading.Lock()
 bgpa_mutex = threading.Lock()
 topo_mutex = threading.Lock()
 AN_mutex = threading.Lock()
+validated_mutex = threading.Lock()
+serialized_mutex = threading.Lock()
+relay_mutex = threading.Lock()
+inventory_mutex = threading.Lock()
+work_mutex = threading.Lock()
+resolve_mutex = threading.Lock()  # held while the conflicts are resolved in the background
+
+mining_cancel = threading.Event()  # set when the chain changes while a block is being mined
+resolve_requested = threading.Event()  # set when a neighbor asks to resolve the conflicts
 
 
 def init_nodes():
     """
-    Reads the known ASes from the file and updates the ASN_nodes list.
+    Reads the known ASes from the file and adds them to the AS registry.
     """
     f = open('bgp_network.csv', 'r')
     try:
@@ -56,7 +70,7 @@ def init_nodes():
         for row in reader:
             if reader.line_num != 1:
                 ip, port, asn = row
-                ASN_nodes.append([ip, int(port), asn, None])  # IP,PORT,AS number,Node's public key
+                AS_registry.add(ip, int(port), asn)  # the public key is not known yet
     finally:
         f.close()
 
@@ -76,3 +90,47 @@ init_nodes()
 my_IP = ''
 my_Port = ''
 my_ASN = ''
+mining_workers = 1  # number of processes that search for the Proof of Work nonce
+
+# Proof of Work difficulty (number of leading zeroes in the block hash)
+initial_difficulty = 4  # the difficulty of the first blocks of the chain
+retarget_interval = 10  # the difficulty is recalculated every retarget_interval blocks
+target_block_time = 60  # the time (in secs) it should take to mine a block
+work_cache_size = 10000  # the number of blocks whose cumulative chain work a node remembers
+
+# Chain synchronization
+sync_page_size = 100  # the maximum number of blocks a node sends in one response of /blocks or /bodies
+sync_header_page_size = 2000  # the maximum number of block headers a node sends in one response of /headers
+sync_workers = 16  # the number of neighbors that are queried in parallel
+peer_timeout = 5  # the time (in secs) to wait for a response from a neighbor
+sync_deadline = 30  # the time (in secs) a node waits for the chains of its neighbors in resolve_conflicts
+sync_chunk_size = 16384  # the number of bytes of a chain download that are read at a time
+max_undo_depth = 100  # the number of the last blocks that can be rolled back without rebuilding the state
+
+checkpoint_interval = 10  # a checkpoint of the chain and the state is stored every checkpoint_interval blocks
+block_cache_size = 1000  # the number of decoded blocks a node with a block store keeps in memory
+serialized_cache_size = 10000  # the number of blocks whose JSON form is kept, for the responses of /chain and /blocks
+
+# Chain validation
+validation_workers = 4  # the number of processes that check the Proof of Work and the signatures of a chain
+validation_chunk_size = 200  # the number of blocks a validation process checks at a time
+validated_cache_size = 10000  # the number of validated block headers a node remembers
+
+# Outbound messages
+outbound_queue_size = 1000  # the number of messages to a neighbor that can wait to be sent, newer ones are dropped
+outbound_retries = 3  # the number of times a message that failed is sent again
+outbound_backoff = 0.5  # the time (in secs) before the first retry, it doubles with every retry
+
+# Peer transport
+peer_port_offset = 1000  # a node listens for the peer transport on its port + peer_port_offset
+transport_workers = 8  # the number of messages from the peer transport that are handled at the same time
+
+# Transaction relay
+relay_batch_window = 0.05  # the time (in secs) a new transaction waits for others to be announced with it
+relay_batch_size = 100  # the maximum number of transactions that are announced in one message
+relay_cache_size = 10000  # the number of announced transactions a node keeps, for the neighbors that ask for them
+relay_request_timeout = 10  # the time (in secs) before a node asks another neighbor for a transaction it asked for
+
+# Signature verification
+signature_cache_size = 10000  # the number of signature verifications a node remembers
+signature_cache = SignatureCache(signature_cache_size)  # shared by the transactions and the blocks
@@ -1,22 +1,29 @@
+import zlib
 import hashlib
-import json
 import requests
 import threading
 from urllib.parse import urlparse
 from networkx.drawing.nx_agraph import to_agraph
 from time import time
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from argparse import ArgumentParser
 from Crypto.PublicKey import RSA
-from config import state, txid_to_block, ASN_nodes, pending_transactions, as2pref, pref2as_pyt
+from config import state, txid_to_block, AS_registry, pending_transactions, as2pref, pref2as_pyt
 from config import node_key, my_IP, my_ASN, my_Port, my_assignments, update_sum, assign_sum
 from config import bgp_txid_announced, mutex, AS_topo, pt_mutex, bgpa_mutex, assigned_prefixes, assign_txids
 from config import as_to_announced_txids, topo_mutex, AN_mutex, alive_neighbors, invalid_transactions
-from config import asn_nodes_mutex, bc_nodes_mutex
+from config import bc_nodes_mutex, mining_workers, mining_cancel, sync_page_size, block_cache_size
+from config import peer_port_offset, peer_timeout, transport_workers, sync_header_page_size
+from config import requested_txids, txid_announcers, inventory_mutex, relay_request_timeout, signature_cache
+from config import resolve_mutex, resolve_requested
 from Blockchain import blockchain
 from Transaction import AssignTransaction, RevokeTransaction, UpdateTransaction
 from BGP_Transaction import BGP_Announce, BGP_Withdraw
 from Block import Block
+import wire
+import checkpoint
+from block_store import BlockStore
+from peer_transport import PeerTransport, PeerServer
 
 """
 Main script.
@@ -24,6 +31,34 @@ Main script.
 
 app = Flask(__name__)
 
+
+def request_values():
+    """
+    Returns the values posted by another node, in JSON or in the binary wire format.
+    """
+    return wire.decode_message(request.get_data(), request.mimetype)
+
+
+def wants_binary():
+    """
+    Checks if the requesting node asked for the binary wire format.
+    """
+    return request.args.get('format') == 'binary' or wire.CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def requested_range(length):
+    """
+    Reads the range of blocks a node asked for, from the query parameters from and to.
+
+    :param length: <int> The length of the chain.
+    :return: <tuple> (start, end) within the chain, None if from or to is negative.
+    """
+    start = request.args.get('from', 0, type=int)
+    end = request.args.get('to', length, type=int)
+    if start < 0 or end < 0:
+        return None
+    return min(start, length), min(end, length)
+
 """ --------------------------------------Routes and functions for the network-------------------------------------- """
 
 
@@ -33,12 +68,12 @@ def register_nodes():
     The node running the script enters the BC network.
     """
     # first register the bootstrap nodes
-    for asn in ASN_nodes:
-        if my_IP in asn and my_Port == asn[1]:
+    for asn in AS_registry:
+        if my_IP == asn.ip and my_Port == asn.port:
             continue
         else:
-            ip = "http://" + asn[0] + ":" + str(asn[1])
-            blockchain.register_node(ip, asn[2])
+            ip = "http://" + asn.ip + ":" + str(asn.port)
+            blockchain.register_node(ip, asn.asn)
 
     # then find out about the rest of the network
     bc_nodes_mutex.acquire()
@@ -104,38 +139,26 @@ def broadcast_public_key():
     in the blockchain network.
 
     """
-    headers = {
-        "Content-Type": "application/json"
-    }
-
     my_info = {
         'public_key': node_key.publickey().exportKey().decode(),
         'IPAddress': my_IP,
         'Port': my_Port,
         'ASN': my_ASN
     }
-    my_data = json.dumps(my_info)
+    my_data, headers = wire.encode_message(my_info, blockchain.binary_wire)
 
     print("Broadcasting my public key to the network...")
     bc_nodes_mutex.acquire()
-    neighbors = blockchain.nodes
-    for node in neighbors:
-        try:
-            requests.post('{}/public_key/incoming'.format(node[0]), data=my_data, headers=headers)
-        except:
-            print("Could not contact node {}. Moving on...".format(node[0]))
-            continue
+    neighbors = list(blockchain.nodes)
     bc_nodes_mutex.release()
+    blockchain.outbound.broadcast(neighbors, 'POST', '/public_key/incoming', my_data, headers)
 
 
 def update_nodes_publicKey(externKey, IPAddress, port):
     """
     Updates the public key entry of a node.
     """
-    for i in range(len(ASN_nodes)):
-        if ASN_nodes[i][0] == IPAddress and ASN_nodes[i][1] == port:
-            ASN_nodes[i][-1] = RSA.importKey(externKey)
-            break
+    AS_registry.set_public_key(IPAddress, int(port), RSA.importKey(externKey))
 
 
 def request_public_key():
@@ -163,12 +186,13 @@ def request_public_key():
 
 
 @app.route('/public_key/incoming', methods=['POST'])
-def receive_incoming_public_key():
+def receive_incoming_public_key(values=None):
     """
     A node receives a public key, the IP Address and Port from another node.
     Updates the ASN Nodes list.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
     # Check that required fields are in the posted data
     required = ['public_key', 'IPAddress', 'Port', 'ASN']
     if not all(k in values for k in required):
@@ -179,16 +203,7 @@ def receive_incoming_public_key():
     asn = values['ASN']
     public_key = values['public_key']
 
-    found = 0
-    asn_nodes_mutex.acquire()
-    for AS in ASN_nodes:
-        if ip in AS and int(port) == AS[1]:
-            found = 1
-            break
-    asn_nodes_mutex.release()
-
-    if found == 0:
-        ASN_nodes.append([ip, int(port), asn, None])
+    if AS_registry.add(ip, int(port), asn):
         addr = "http://" + ip + ":" + str(port)
         blockchain.register_node(addr, asn)
 
@@ -197,12 +212,13 @@ def receive_incoming_public_key():
 
 
 @app.route('/alive', methods=['POST'])
-def neighbor_is_alive():
+def neighbor_is_alive(values=None):
     """
     It updates the alive neighbors dictionary every time
     a neighbor sends an alive message.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
     required = ['ip', 'port']
     if not all(k in values for k in required):
         return 'Missing values', 400
@@ -221,22 +237,15 @@ def send_alive():
     Send an alive message to all the neighbors.
     This function is being called every 20 seconds.
     """
-    headers = {
-        "Content-Type": "application/json"
-    }
     my_info = {
         'ip':  my_IP,
         'port': my_Port,
     }
-    my_data = json.dumps(my_info)
+    my_data, headers = wire.encode_message(my_info, blockchain.binary_wire)
     bc_nodes_mutex.acquire()
-    for node in blockchain.nodes:
-        try:
-            requests.post('{}/alive'.format(node[0]), data=my_data, headers=headers)  # send alive to every neighbor
-        except:
-            print("Could not contact node {}. Moving on...".format(node[0]))
-            continue
+    neighbors = list(blockchain.nodes)
     bc_nodes_mutex.release()
+    blockchain.outbound.broadcast(neighbors, 'POST', '/alive', my_data, headers)  # send alive to every neighbor
     # start a timer that calls this function every 20 seconds.
     threading.Timer(20.0, send_alive).start()
 
@@ -266,17 +275,16 @@ def check_alive():
         neighbors.remove(node)
         AN_mutex.acquire()
         alive_neighbors.pop(node[0])
-        asn_nodes_mutex.acquire()
-        remove_from_ASN_Nodes(node[0])
-        asn_nodes_mutex.release()
+        blockchain.outbound.remove_peer(node[0])
+        remove_from_AS_registry(node[0])
         AN_mutex.release()
     # start a timer that calls this function every 60 seconds.
     threading.Timer(60.0, check_alive).start()
 
 
-def remove_from_ASN_Nodes(url):
+def remove_from_AS_registry(url):
     """
-    Removes dead neighbors from the ASN Nodes list,
+    Removes dead neighbors from the AS registry,
     so that we can register them again if they rejoin the network.
     that contain offline information about a neighbor i.e. its public key.
     :param url: the url address of the neighbor
@@ -285,13 +293,7 @@ def remove_from_ASN_Nodes(url):
     ip_port_list = parsed_url.netloc.split(":")
     ip_addr = ip_port_list[0]
     port = int(ip_port_list[1])
-    node = None
-    for asn in ASN_nodes:
-        if ip_addr in asn and port == asn[1]:
-            node = asn
-            break
-    if node is not None:
-        ASN_nodes.remove(node)
+    AS_registry.remove(ip_addr, port)
 
 
 @app.route('/', methods=['GET'])
@@ -310,6 +312,8 @@ def start():
     send_alive()
     # start timer to check your neighbors
     check_alive()
+    # start timer to ask again for the announced transactions that didn't arrive
+    retry_requested_transactions()
     return "Successfully entered the BC network.", 200
 
 
@@ -369,11 +373,12 @@ def new_assign_transaction():
 
 
 @app.route('/transactions/assign/incoming', methods=['POST'])
-def receive_incoming_assign_transaction():
+def receive_incoming_assign_transaction(values=None):
     """
     Receive an incoming transaction sent by an AS.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
 
     # Check that the required fields are in the posted data
     required = ['prefix', 'as_source', 'as_dest', 'source_lease', 'leaseDuration', 'transferTag', 'signature', 'time',
@@ -452,11 +457,12 @@ def new_revoke_transaction():
 
 
 @app.route('/transactions/revoke/incoming', methods=['POST'])
-def receive_incoming_revoke_transaction():
+def receive_incoming_revoke_transaction(values=None):
     """
     Receive an incoming Revoke transaction sent by an AS.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
 
     # Check that the required fields are in the posted data
     required = ['as_source', 'assign_tran_id', 'time', 'signature']
@@ -528,11 +534,12 @@ def new_update_transaction():
 
 
 @app.route('/transactions/update/incoming', methods=['POST'])
-def receive_incoming_update_transaction():
+def receive_incoming_update_transaction(values=None):
     """
     Receive an incoming Update transaction sent by an AS.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
 
     # Check that the required fields are in the posted data
     required = ['as_source', 'assign_tran_id', 'time', 'signature', 'new_lease']
@@ -600,18 +607,19 @@ def new_bgp_announce():
     new_trans_dict = new_trans.return_transaction()  # also validates the transaction
 
     if new_trans_dict is not None and not check_announce(as_source, prefix, as_source_list, as_dest_list, bgp_timestamp):
-        blockchain.update_bgp_announce(new_trans_dict['trans'])
+        blockchain.update_bgp_announce(new_trans_dict)
         pending_transactions.append(new_trans_dict)  # to be mined later
 
     return 'New BGP Announce transaction created. It was also broadcasted to the network', 200
 
 
 @app.route('/transactions/bgp_announce/incoming', methods=['POST'])
-def bgp_announce_incoming():
+def bgp_announce_incoming(values=None):
     """
     Receive an incoming BGP Announce transaction sent by an AS.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
 
     # Check that the required fields are in the posted data
     required = ['prefix', 'bgp_timestamp', 'as_source', 'as_source_list', 'as_dest_list', 'signature', 'time']
@@ -636,7 +644,7 @@ def bgp_announce_incoming():
 
     if new_trans_dict is not None and not check_announce(as_source, prefix, as_source_list, as_dest_list, bgp_timestamp):
         pending_transactions.append(new_trans_dict)  # to be mined later
-        blockchain.update_bgp_announce(new_trans_dict['trans'])
+        blockchain.update_bgp_announce(new_trans_dict)
         # for out of order transactions
         if tran_hash in invalid_transactions:
             invalid_transactions.remove(tran_hash)
@@ -685,11 +693,12 @@ def new_bgp_withdraw():
 
 
 @app.route('/transactions/bgp_withdraw/incoming', methods=['POST'])
-def bgp_withdraw_incoming():
+def bgp_withdraw_incoming(values=None):
     """
     Receive an incoming BGP Withdraw transaction sent by an AS.
     """
-    values = request.get_json()
+    if values is None:
+        values = request_values()
 
     # Check that the required fields are in the posted data
     required = ['prefix', 'as_source', 'signature', 'time']
@@ -722,6 +731,142 @@ def bgp_withdraw_incoming():
         return "Incoming BGP Withdraw transaction invalid. Transaction is not accepted", 500
 
 
+def missing_transactions(txids, node=None):
+    """
+    Finds the announced transactions that this node doesn't have: they are not pending, not in the chain
+    and they were not asked for from another neighbor in the last relay_request_timeout secs.
+    A transaction that was received but was not valid, e.g. because it arrived out of order, is asked for again.
+    If a transaction was already asked for, the neighbor is remembered and asked for it if the request times out.
+
+    :param txids: <list> The announced txids.
+    :param node: <str> The url of the neighbor that announced them, None if it is not known.
+    :return: <list> The txids of the transactions the neighbor should send.
+    """
+    known = set(transaction.txid for transaction in list(pending_transactions))
+
+    inventory_mutex.acquire()
+    now = time()
+    missing = []
+    for txid in txids:
+        if txid in known or txid in txid_to_block:
+            continue
+        asked = requested_txids.get(txid)
+        if asked is not None and now - asked <= relay_request_timeout:
+            if node is not None and node not in txid_announcers.setdefault(txid, []):
+                txid_announcers[txid].append(node)
+            continue
+        requested_txids[txid] = now
+        requested_txids.move_to_end(txid)
+        missing.append(txid)
+    inventory_mutex.release()
+    return missing
+
+
+def retry_requested_transactions():
+    """
+    Asks again for the announced transactions that were requested but didn't arrive in relay_request_timeout secs,
+    each from the next neighbor that announced it. A transaction that arrived, valid or not, or that no other
+    neighbor announced is forgotten, it is asked for again when it is announced again.
+    """
+    known = set(transaction.txid for transaction in list(pending_transactions))
+    invalid = set(invalid_transactions)
+
+    inventory_mutex.acquire()
+    now = time()
+    retries = {}  # { url of a neighbor : [txid, ...] }
+    # the txids are in the order they were asked for, so the expired ones are at the beginning
+    expired = []
+    for txid, asked in requested_txids.items():
+        if now - asked <= relay_request_timeout:
+            break
+        expired.append(txid)
+    for txid in expired:
+        announcers = txid_announcers.get(txid)
+        if txid in known or txid in txid_to_block or txid in invalid or not announcers:
+            requested_txids.pop(txid)
+            txid_announcers.pop(txid, None)
+            continue
+        retries.setdefault(announcers.pop(0), []).append(txid)
+        requested_txids[txid] = now
+        requested_txids.move_to_end(txid)
+    inventory_mutex.release()
+
+    for node, txids in retries.items():
+        request_data, headers = wire.encode_message({'txids': txids}, blockchain.binary_wire)
+        blockchain.outbound.send(node, 'POST', '/transactions/relay', request_data, headers,
+                                 lambda url, values: receive_transaction_batch(values['transactions']))
+    # start a timer that calls this function every relay_request_timeout seconds.
+    threading.Timer(relay_request_timeout, retry_requested_transactions).start()
+
+
+@app.route('/inventory', methods=['POST'])
+def receive_inventory():
+    """
+    Receive the txids of the transactions a neighbor announces.
+
+    :return: <json> {'missing': [txid, ...]} The txids of the transactions this node wants.
+    """
+    values = request_values()
+    if 'txids' not in values:
+        return 'Missing values', 400
+    return jsonify({'missing': missing_transactions(values['txids'], values.get('node'))}), 200
+
+
+@app.route('/transactions/relay', methods=['POST'])
+def send_announced_transactions():
+    """
+    A node sends the transactions it announced upon request, e.g. to a neighbor whose first request timed out.
+
+    :return: <json> {'transactions': [...]} The requested transactions this node still keeps.
+    """
+    values = request_values()
+    if 'txids' not in values:
+        return 'Missing values', 400
+    return jsonify({'transactions': blockchain.announced_transactions(values['txids'])}), 200
+
+
+# the handler of every type of incoming transaction
+incoming_handlers = {
+    "Assign": receive_incoming_assign_transaction,
+    "Revoke": receive_incoming_revoke_transaction,
+    "Update": receive_incoming_update_transaction,
+    "BGP Announce": bgp_announce_incoming,
+    "BGP Withdraw": bgp_withdraw_incoming
+}
+
+
+def receive_transaction_batch(transactions):
+    """
+    Validates a batch of incoming transactions of any type, in the order they were sent.
+    Every transaction is passed to the handler of its type.
+
+    :param transactions: <list> The transactions, as dictionaries.
+    :return: <list> [ {'status': status code, 'message': the response of the handler}, ... ] in the order of the batch.
+    """
+    statuses = []
+    for values in transactions:
+        handler = incoming_handlers.get(values.get('type'))
+        if handler is None:
+            statuses.append({'status': 400, 'message': 'Unknown transaction type'})
+            continue
+        message, status = handler(values)
+        statuses.append({'status': status, 'message': message})
+    return statuses
+
+
+@app.route('/transactions/batch/incoming', methods=['POST'])
+def receive_incoming_transaction_batch():
+    """
+    Receive a batch of incoming transactions of any type sent by an AS.
+
+    :return: <json> {'statuses': [ {'status': status code, 'message': ...}, ... ]} in the order of the batch.
+    """
+    values = request_values()
+    if 'transactions' not in values:
+        return 'Missing values', 400
+    return jsonify({'statuses': receive_transaction_batch(values['transactions'])}), 200
+
+
 def check_lease():
     """
     Goes through every transaction in pending transactions and removes all the assign/update
@@ -733,23 +878,23 @@ def check_lease():
     current_update_lease = -2000  # a very small number
     i = 0
     while i < len(pending_transactions):
-        trans = pending_transactions[i]['trans']
+        trans = pending_transactions[i]
 
-        if trans['type'] == "Assign":
-            as_assign_source = trans['input'][1]
-            original_lease = trans['input'][3]
-            lease = trans['input'][4]
+        if trans.type == "Assign":
+            as_assign_source = trans.as_source
+            original_lease = trans.source_lease
+            lease = trans.lease_duration
 
             if not check_assign(as_assign_source, original_lease, lease):
                 pending_transactions.remove(pending_transactions[i])  # this transaction is invalid
                 i -= 1
 
-        elif trans['type'] == "Update":
-            as_assign_source = trans['input'][0]
-            txid = trans['input'][1]
-            lease = trans['input'][2]
+        elif trans.type == "Update":
+            as_assign_source = trans.as_source
+            txid = trans.assign_txid
+            lease = trans.new_lease
             assign_tran = blockchain.find_by_txid(txid)
-            original_lease = assign_tran['trans']['input'][3]
+            original_lease = assign_tran.source_lease
 
             if lease > current_update_lease:
                 current_update_lease = lease
@@ -838,10 +983,10 @@ def check_withdraw(prefix, as_source):
     :return: <Bool> True if the withdraw transaction has not been already made in the same block, False otherwise.
     """
     for i in range (len(pending_transactions)):
-        trans = pending_transactions[i]['trans']
-        if trans['type'] == "BGP Withdraw":
-            w_prefix = trans['input'][0]
-            w_as_source = trans['input'][1]
+        trans = pending_transactions[i]
+        if trans.type == "BGP Withdraw":
+            w_prefix = trans.prefix
+            w_as_source = trans.as_source
             if w_prefix == prefix and w_as_source == as_source:
                 return False
     return True
@@ -876,40 +1021,223 @@ def full_chain():
     """
     A node sends its own copy of the blockchain upon request.
 
-    :return: <dict> Containing the chain and its length.
+    The JSON response is streamed from the serialized blocks (see Blockchain.serialize_block),
+    compressed with gzip if the requesting node accepts it. The ETag of the response is the hash of the last block
+    and the length of the chain, so a node that already has this chain gets a 304 response. The hash identifies
+    the chain because the hash of every block we adopt is checked (see Blockchain.first_invalid_header).
+
+    :return: <dict> Containing the chain and its length. (or the encoded chain in the binary wire format)
+    """
+    chain = blockchain.chain
+    if isinstance(chain, BlockStore):
+        chain = chain.view()
+    binary = wants_binary()
+    compress = not binary and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+    etag = '{}-{}-{}'.format(chain[-1].hash, len(chain), 'binary' if binary else 'gzip' if compress else 'json')
+    headers = {'ETag': '"{}"'.format(etag), 'Vary': 'Accept, Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    if binary:
+        return Response(wire.encode_chain(chain), mimetype=wire.CONTENT_TYPE, headers=headers), 200
+
+    length = len(chain)
+
+    def stream():
+        yield b'{"chain": ['
+        for index in range(length):
+            if index > 0:
+                yield b', '
+            yield blockchain.serialize_block(chain[index])
+        yield '], "length": {}}}'.format(length).encode()
+
+    if not compress:
+        return Response(stream(), mimetype='application/json', headers=headers), 200
+
+    def gzip_stream():
+        compressor = zlib.compressobj(wbits=31)  # 31: with a gzip header
+        for data in stream():
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    headers['Content-Encoding'] = 'gzip'
+    return Response(gzip_stream(), mimetype='application/json', headers=headers), 200
+
+
+@app.route('/tip', methods=['GET'])
+def chain_tip():
     """
-    dict_chain = []
-    for block in blockchain.chain:
-        dict_chain.append(block.__dict__)  # convert Block objects to dictionaries for json export
+    A node sends the length of its own copy of the blockchain, the hash of its last block
+    and its cumulative work upon request.
+
+    :return: <dict> Containing the length of the chain, the hash of its last block and its work.
+             (or the encoded dictionary in the binary wire format)
+    """
+    chain = blockchain.chain
+    if isinstance(chain, BlockStore):
+        chain = chain.view()
     response = {
-        'chain': dict_chain,
-        'length': len(blockchain.chain)
+        'length': len(chain),
+        'hash': chain[-1].hash,
+        'work': blockchain.chain_work(chain)
     }
+
+    if wants_binary():
+        return Response(wire.dumps(response), mimetype=wire.CONTENT_TYPE), 200
     return jsonify(response), 200
 
 
+@app.route('/headers', methods=['GET'])
+def chain_headers():
+    """
+    A node sends the headers of the blocks of its own copy of the blockchain upon request.
+    Query parameters: from (the index of the first block, default 0) and to (the index after the last block).
+    A page has at most sync_header_page_size headers, the requesting node asks for the next page if it needs more.
+
+    :return: <dict> Containing the block headers and their number. (or the encoded headers in the binary wire format)
+    """
+    chain = blockchain.chain
+    if isinstance(chain, BlockStore):
+        chain = chain.view()
+    block_range = requested_range(len(chain))
+    if block_range is None:
+        return "Invalid range of blocks", 400
+    start, end = block_range
+    end = min(end, start + sync_header_page_size)
+
+    if wants_binary():
+        return Response(wire.encode_chain(chain[start:end], False), mimetype=wire.CONTENT_TYPE), 200
+
+    headers = [block.header() for block in chain[start:end]]
+    response = {
+        'headers': headers,
+        'length': len(headers)
+    }
+    return jsonify(response), 200
+
+
+@app.route('/blocks', methods=['GET'])
+def chain_blocks():
+    """
+    A node sends a page of the blocks of its own copy of the blockchain upon request.
+    Query parameters: from (the index of the first block, default 0) and to (the index after the last block).
+    A page has at most sync_page_size blocks, the requesting node asks for the next page if it needs more.
+
+    :return: <dict> Containing the blocks and the length of the chain. (or the encoded blocks in the binary wire format)
+    """
+    chain = blockchain.chain
+    if isinstance(chain, BlockStore):
+        chain = chain.view()
+    block_range = requested_range(len(chain))
+    if block_range is None:
+        return "Invalid range of blocks", 400
+    start, end = block_range
+    end = min(end, start + sync_page_size)
+
+    if wants_binary():
+        return Response(wire.encode_chain(chain[start:end]), mimetype=wire.CONTENT_TYPE), 200
+
+    blocks = b', '.join(blockchain.serialize_block(block) for block in chain[start:end])
+    response = b'{"blocks": [' + blocks + '], "length": {}}}'.format(len(chain)).encode()
+    return Response(response, mimetype='application/json'), 200
+
+
+@app.route('/bodies', methods=['GET'])
+def chain_bodies():
+    """
+    A node sends the transactions of the blocks of its own copy of the blockchain upon request.
+    Query parameters: from (the index of the first block, default 0) and to (the index after the last block).
+    A page has at most sync_page_size bodies, the requesting node asks for the next page if it needs more.
+
+    :return: <dict> Containing the index and the transactions of every requested block.
+             (or the encoded bodies in the binary wire format)
+    """
+    chain = blockchain.chain
+    if isinstance(chain, BlockStore):
+        chain = chain.view()
+    block_range = requested_range(len(chain))
+    if block_range is None:
+        return "Invalid range of blocks", 400
+    start, end = block_range
+    end = min(end, start + sync_page_size)
+
+    if wants_binary():
+        bodies = wire.frame([wire.encode_body(block) for block in chain[start:end]])
+        return Response(bodies, mimetype=wire.CONTENT_TYPE), 200
+
+    bodies = []
+    for block in chain[start:end]:
+        bodies.append({
+            'index': block.index,
+            'transactions': [transaction.to_dict() for transaction in block.transactions]
+        })
+    return jsonify({'bodies': bodies}), 200
+
+
 @app.route('/resolve', methods=['GET'])
 def resolve():
     """
     Every node resolves any conflicts with other nodes in the network.
+    The conflicts are resolved in the background and the request is answered at once: a resolve can take up to
+    sync_deadline secs, longer than the neighbor waits for an answer before it sends the request again.
+    The requests that arrive while a resolve runs are served by one more resolve after it.
     """
-    blockchain.resolve_conflicts()
+    resolve_requested.set()
+    if resolve_mutex.acquire(blocking=False):
+        threading.Thread(target=resolve_in_background).start()
     return "OK", 200
 
 
+def resolve_in_background():
+    """
+    Resolves the conflicts until no neighbor asked again, the caller holds resolve_mutex.
+    """
+    while True:
+        try:
+            while resolve_requested.is_set():
+                resolve_requested.clear()
+                blockchain.resolve_conflicts()
+        finally:
+            resolve_mutex.release()
+        # a request that arrived after the last check found resolve_mutex held and didn't start a resolve
+        if not resolve_requested.is_set() or not resolve_mutex.acquire(blocking=False):
+            return
+
+
+@app.route('/outbound/stats', methods=['GET'])
+def outbound_stats():
+    """
+    Returns the depth of the outbound queue of every neighbor and the number of messages
+    that were sent, dropped because the queue was full, failed after all the retries and retried.
+
+    :return: <json> { url of the neighbor : {'depth', 'sent', 'dropped', 'failed', 'retried'} }
+    """
+    return jsonify(blockchain.outbound.stats()), 200
+
+
+@app.route('/signatures/stats', methods=['GET'])
+def signature_stats():
+    """
+    Returns the number of signature verifications that were answered by the signature cache (hits)
+    and the number that had to be verified (misses).
+
+    :return: <json> {'entries', 'size', 'hits', 'misses', 'hit_rate'}
+    """
+    return jsonify(signature_cache.stats()), 200
+
+
 def broadcast_resolve_message():
     """
     Send a message to every other node in the blockchain network to check for any conflicts
     """
-    neighbors = blockchain.nodes
-    for node in neighbors:
-        try:
-            # we want async requests here.
-            # miners could slow down each other because this request is not async.
-            requests.get('{}/resolve'.format(node[0]))
-        except:
-            print("Could not contact node {}. Moving on...".format(node[0]))
-            continue
+    bc_nodes_mutex.acquire()
+    neighbors = list(blockchain.nodes)
+    bc_nodes_mutex.release()
+    # queued, so that a miner doesn't wait for the other nodes to resolve their conflicts
+    blockchain.outbound.broadcast(neighbors, 'GET', '/resolve')
 
 
 def remove_pending_transactions():
@@ -920,8 +1248,8 @@ def remove_pending_transactions():
 
     i = 0
     while i < len(pending_transactions):
-        trans = pending_transactions[i]['trans']
-        if trans['txid'] in txid_to_block.keys():
+        trans = pending_transactions[i]
+        if trans.txid in txid_to_block.keys():
             pending_transactions.remove(pending_transactions[i])
             i -= 1
         i += 1
@@ -938,8 +1266,8 @@ def check_prefixes():
 
     i = 0
     while i < len(pending_transactions):
-        trans = pending_transactions[i]['trans']
-        if trans['type'] == "BGP Announce" and trans['input'][0] in assigned_prefixes:
+        trans = pending_transactions[i]
+        if trans.type == "BGP Announce" and trans.prefix in assigned_prefixes:
             pending_transactions.remove(pending_transactions[i])
             i -= 1
         i += 1
@@ -952,34 +1280,56 @@ def mine():
     """
     Mines a new block.
     Adds a new block that include all the valid transactions to the chain if the mining was successful.
+
+    The lock is not held while searching for the Proof of Work, so that resolve_conflicts can replace the chain.
+    If that happens the search is cancelled and a new block is built on top of the new last block.
     """
     blockchain.resolve_conflicts()  # check the network before mining a new block
 
     check_prefixes()
 
-    mutex.acquire()  # lock
+    while True:
+        mutex.acquire()  # lock
 
-    if blockchain.check_before_mining:
-        remove_pending_transactions()
+        if blockchain.check_before_mining:
+            remove_pending_transactions()
+
+        if len(pending_transactions) == 0:
+            mutex.release()  # unlock
+            break
 
-    if len(pending_transactions) > 0:
         last_block = blockchain.get_last_block()  # check critical region
         last_block_hash = last_block.hash
 
         check_lease()
 
-        for i in range(len(pending_transactions)):
-            # update txid_to_block with all the txids that are about to be mined
-            tran = pending_transactions[i]['trans']
-            txid = tran['txid']
-            txid_to_block[txid] = len(blockchain.chain)
+        index = len(blockchain.chain)
+        difficulty = blockchain.next_difficulty(blockchain.chain, index)
+        block = Block(index, time(), pending_transactions, last_block_hash, difficulty)
+        mining_cancel.clear()
 
-        block = Block(len(blockchain.chain), time(), pending_transactions, last_block_hash)
+        mutex.release()  # unlock
 
         print("Mining...")
-        block.proof_of_work()
+        hash_rates = block.proof_of_work(mining_workers, mining_cancel)
+
+        mutex.acquire()  # lock
+
+        if hash_rates is None or blockchain.get_last_block().hash != last_block_hash:
+            # a chain with more work was adopted while mining, start over on top of it.
+            mutex.release()  # unlock
+            print("The chain has changed. Restarting mining...")
+            continue
+
+        for worker_id, rate in sorted(hash_rates.items()):
+            print("Worker {}: {:.0f} hashes/sec".format(worker_id, rate))
+
         block.mined_timestamp = time()
 
+        for transaction in block.transactions:
+            # update txid_to_block with all the txids that were mined
+            txid_to_block[transaction.txid] = block.index
+
         block_hash = block.calculate_hash()
         signature = node_key.sign(block_hash.encode(), '')
         block.sign(signature)
@@ -995,7 +1345,9 @@ def mine():
         assign_txids.clear()
         remove_pending_transactions()
 
-    mutex.release()  # unlock
+        mutex.release()  # unlock
+        break
+
     broadcast_resolve_message()  # let everyone know that the chain has changed
     return "Mined one block", 200
 
@@ -1009,7 +1361,7 @@ def mine():
 @app.route('/debug', methods=['GET'])
 def print_for_debugging():
     print("\nAS NODES:")
-    print(ASN_nodes)
+    print(list(AS_registry))
     print("\nTXID_TO_BLOCK:")
     print(txid_to_block)
     print("\nSTATE:")
@@ -1089,7 +1441,7 @@ def find_transaction_by_txid():
 
     if index == 0:  # this is the genesis transaction
         block = blockchain.chain[0]
-        requested_tran = block.transactions
+        requested_tran = [transaction.to_dict() for transaction in block.transactions]
         response = {
             'transaction': requested_tran
         }
@@ -1098,30 +1450,63 @@ def find_transaction_by_txid():
     if index > 0:  # every other valid transaction
         chain = blockchain.chain
         block = chain[index]
-        for i in range(len(block.transactions)):
-            if txid == block.transactions[i]['trans']['txid']:
-                requested_tran = block.transactions[i]
+        for transaction in block.transactions:
+            if txid == transaction.txid:
+                requested_tran = transaction.to_dict()
                 response = {
                     'transaction': requested_tran
                 }
                 return jsonify(response), 200
 
 
+@app.route('/transactions/proof', methods=['POST'])
+def transaction_inclusion_proof():
+    """
+    Returns the Merkle inclusion proof of a transaction given its transaction id (txid).
+    The proof can be checked against the Merkle root of the block with merkle.verify_proof.
+
+    :return: <dict>, <status code> The proof if the transaction is in the blockchain.
+    """
+    values = request.get_json()
+
+    required = ['txid']
+    if not all(k in values for k in required):
+        return 'Missing values', 400
+
+    proof = blockchain.inclusion_proof(values['txid'])
+    if proof is None:
+        return "Transaction does not exist", 500
+    return jsonify(proof), 200
+
+
 """ ---------------------------------------------------------------------------------------------------------------- """
 
 
 """ ------------------------------------------------------Main------------------------------------------------------ """
 
 
+# the routes that other nodes can send messages to over the peer transport, { route : function(values) }
+peer_routes = {
+    '/public_key/incoming': receive_incoming_public_key,
+    '/alive': neighbor_is_alive,
+    '/transactions/assign/incoming': receive_incoming_assign_transaction,
+    '/transactions/revoke/incoming': receive_incoming_revoke_transaction,
+    '/transactions/update/incoming': receive_incoming_update_transaction,
+    '/transactions/bgp_announce/incoming': bgp_announce_incoming,
+    '/transactions/bgp_withdraw/incoming': bgp_withdraw_incoming,
+    '/inventory': lambda values: ({'missing': missing_transactions(values['txids'], values.get('node'))}, 200),
+    '/transactions/relay': lambda values: ({'transactions': blockchain.announced_transactions(values['txids'])}, 200),
+    '/transactions/batch/incoming':
+        lambda values: ({'statuses': receive_transaction_batch(values['transactions'])}, 200),
+    '/resolve': lambda values: resolve()
+}
+
+
 def update_my_publicKey(myIP, myPort):
     """
-    Updates the node's public key entry in the ASN list.
+    Updates the node's public key entry in the AS registry.
     """
-    for asn in ASN_nodes:
-        if myIP in asn:
-            if myPort == asn[1]:
-                asn[-1] = node_key.publickey()
-                break
+    AS_registry.set_public_key(myIP, myPort, node_key.publickey())
 
 
 if __name__ == '__main__':
@@ -1129,22 +1514,34 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
     parser.add_argument('-a', '--asn', help='the as number of the node')
     parser.add_argument('-i', '--ip', default='localhost', type=str, help='node\'s ip')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='number of mining processes')
+    parser.add_argument('-b', '--binary', action='store_true', help='use the binary wire format with other nodes')
+    parser.add_argument('-c', '--checkpoint', default=None, type=str, help='file to store the checkpoints in')
+    parser.add_argument('-s', '--store', default=None, type=str, help='path of the block store on disk')
+    parser.add_argument('-t', '--transport', action='store_true',
+                        help='send messages to other nodes over persistent connections')
     args = parser.parse_args()
 
     my_Port = args.port
     my_IP = args.ip
     my_ASN = args.asn
+    mining_workers = args.workers
+    blockchain.binary_wire = args.binary
+    blockchain.url = 'http://{}:{}'.format(my_IP, my_Port)
 
-    found = 0
+    if args.store is not None:
+        blockchain.use_block_store(BlockStore(args.store, block_cache_size))
 
-    for asn in ASN_nodes:
-        if my_IP in asn and my_Port == asn[1]:
-            found = 1
-            break
+    loaded = args.checkpoint is not None and checkpoint.load_checkpoint(blockchain, args.checkpoint)
+    if args.store is not None and not loaded:
+        blockchain.rebuild_state()  # the state of the chain in the store
+    blockchain.checkpoint_path = args.checkpoint
 
-    if found == 0:
-        ASN_nodes.append([my_IP, my_Port, my_ASN, node_key.publickey()])
-    else:
+    if args.transport:
+        PeerServer(my_IP, my_Port + peer_port_offset, peer_routes, transport_workers).start()
+        blockchain.outbound.transport = PeerTransport(peer_port_offset, peer_timeout)
+
+    if not AS_registry.add(my_IP, my_Port, my_ASN, node_key.publickey()):
         update_my_publicKey(my_IP, my_Port)
 
     app.run(host=my_IP, port=my_Port, threaded=True)
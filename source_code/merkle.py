@@ -0,0 +1,105 @@
+import json
+import hashlib
+
+"""
+The Merkle module. Builds the Merkle tree of the transactions of a block and the inclusion proofs of its transactions.
+
+As in RFC 6962, a leaf is hashed with a 0x00 prefix and an inner node with a 0x01 prefix,
+so a leaf can't pass for an inner node. The last node of a level with an odd number of nodes
+is moved up to the next level as it is, instead of being paired with itself,
+so the transactions [a, b, c] and [a, b, c, c] don't have the same root.
+"""
+
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def transaction_hash(transaction):
+    """
+    Calculates the hash of a transaction, i.e. a leaf of the Merkle tree.
+    The transaction is hashed in its JSON form, so that a node gets the same hash for a transaction
+    it received from the network.
+
+    :param transaction: <dict> A transaction of a block.
+    :return: <str> The SHA-256 hash of the transaction.
+    """
+    transaction_str = json.dumps(transaction, sort_keys=True).encode()
+    return hashlib.sha256(LEAF_PREFIX + transaction_str).hexdigest()
+
+
+def hash_pair(left, right):
+    """
+    Calculates the hash of an inner node of the Merkle tree.
+
+    :param left: <str> The hash of the left child.
+    :param right: <str> The hash of the right child.
+    :return: <str> The SHA-256 hash of the node.
+    """
+    return hashlib.sha256(NODE_PREFIX + '{}{}'.format(left, right).encode()).hexdigest()
+
+
+def next_level(level):
+    """
+    Calculates the level above this level of the Merkle tree.
+    If a level has an odd number of nodes the last one is moved up as it is.
+    """
+    parents = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2 == 1:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves):
+    """
+    Calculates the root of the Merkle tree.
+
+    :param leaves: <list> The hashes of the transactions.
+    :return: <str> The Merkle root.
+    """
+    if len(leaves) == 0:
+        return hashlib.sha256(b'').hexdigest()
+
+    level = list(leaves)
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, position):
+    """
+    Creates the inclusion proof of a leaf, i.e. the hashes of its siblings from the leaf up to the root.
+    A node that is moved up without a sibling adds nothing to the proof.
+
+    :param leaves: <list> The hashes of the transactions.
+    :param position: <int> The position of the leaf.
+    :return: <list> [ [sibling hash, 'left' or 'right'], ... ]
+    """
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if position % 2 == 0:
+            if position + 1 < len(level):
+                proof.append([level[position + 1], 'right'])
+        else:
+            proof.append([level[position - 1], 'left'])
+        level = next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    """
+    Checks an inclusion proof.
+
+    :param leaf: <str> The hash of the transaction.
+    :param proof: <list> The inclusion proof, as returned by merkle_proof.
+    :param root: <str> The Merkle root of the block.
+    :return: <bool> True if the transaction is included in the block, False otherwise.
+    """
+    node = leaf
+    for sibling, side in proof:
+        if side == 'left':
+            node = hash_pair(sibling, node)
+        else:
+            node = hash_pair(node, sibling)
+    return node == root
@@ -0,0 +1,110 @@
+import hashlib
+import multiprocessing
+import queue
+from time import time
+
+"""
+The Miner module. Splits the Proof of Work nonce search of a block across multiple processes.
+"""
+
+
+def search_nonce(header_prefix, start, stop, step=1, zeroes=4):
+    """
+    The nonce search kernel.
+    The constant part of the block header is hashed once and every nonce only appends its digits
+    to a copy of that hash state. The raw digest is compared to the target instead of its hex string.
+
+    :param header_prefix: <bytes> The bytes of the header that come before the nonce (see Block.header_prefix).
+    :param start: <int> The first nonce to try.
+    :param stop: <int> The search stops before this nonce.
+    :param step: <int> The distance between two nonces that are tried.
+    :param zeroes: <int> The number of leading hex zeroes that the hash must have.
+    :return: <int> The first valid nonce, None if there is no valid nonce in the range.
+    """
+    prefix_state = hashlib.sha256(header_prefix)
+    full_bytes, half_byte = divmod(zeroes, 2)  # every byte of the digest is two hex digits
+    target = bytes(full_bytes)
+
+    for nonce in range(start, stop, step):
+        nonce_state = prefix_state.copy()
+        nonce_state.update(b'%d' % nonce)
+        digest = nonce_state.digest()
+        if digest[:full_bytes] == target and (not half_byte or digest[full_bytes] < 16):
+            return nonce
+    return None
+
+
+def search_nonces(header_prefix, zeroes, start, step, stop_event, results, worker_id, batch_size):
+    """
+    Searches the nonces start, start + step, start + 2*step, ... until a valid one is found
+    or until another worker signals that it found one.
+
+    Runs in a separate process, so it only uses the block fields that make up the hash.
+    """
+    nonce = start
+    start_time = time()
+
+    while not stop_event.is_set():
+        batch_end = nonce + batch_size * step
+        found_nonce = search_nonce(header_prefix, nonce, batch_end, step, zeroes)
+        if found_nonce is not None:
+            stop_event.set()  # let the other workers know that they can stop
+            hashes = (found_nonce - start) // step + 1
+            results.put((worker_id, found_nonce, hashes, time() - start_time))
+            return
+        nonce = batch_end
+
+    hashes = (nonce - start) // step
+    results.put((worker_id, None, hashes, time() - start_time))
+
+
+def parallel_proof_of_work(block, workers=None, batch_size=10000, cancel=None):
+    """
+    Finds a valid nonce for a block using a pool of worker processes.
+    Each worker searches an interleaved slice of the nonce space and all of them stop
+    as soon as one finds a nonce that Block.valid_proof accepts, or as soon as the search is cancelled.
+
+    :param block: <Block> The block to mine.
+    :param workers: <int> The number of worker processes. Defaults to the number of CPUs.
+    :param batch_size: <int> How many nonces a worker tries before it checks if it should stop.
+    :param cancel: <threading.Event> If set, the search is aborted.
+    :return: <tuple> The nonce that was found (None if cancelled) and a dictionary { worker id : hashes/sec }.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    stop_event = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = []
+
+    for worker_id in range(workers):
+        args = (block.header_prefix(), block.difficulty, worker_id, workers, stop_event, results, worker_id, batch_size)
+        process = multiprocessing.Process(target=search_nonces, args=args)
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    nonce = None
+    hash_rates = {}
+    while len(hash_rates) < workers:
+        if cancel is not None and cancel.is_set():
+            stop_event.set()
+        try:
+            worker_id, found_nonce, hashes, elapsed = results.get(timeout=0.1)
+        except queue.Empty:
+            # a worker that was killed (e.g. out of memory) never reports, the others keep searching their slices
+            for dead_id, process in enumerate(processes):
+                if dead_id not in hash_rates and process.exitcode not in (None, 0):
+                    print("Mining worker {} died with exit code {}".format(dead_id, process.exitcode))
+                    hash_rates[dead_id] = 0.0
+            continue
+        if found_nonce is not None and (nonce is None or found_nonce < nonce):
+            nonce = found_nonce
+        hash_rates[worker_id] = hashes / elapsed if elapsed > 0 else 0.0
+
+    for process in processes:
+        process.join()
+
+    if cancel is not None and cancel.is_set():
+        return None, hash_rates
+    return nonce, hash_rates
@@ -0,0 +1,279 @@
+import queue
+import threading
+from time import sleep
+import requests
+import wire
+from peer_transport import PeerTransportError, PeerUnreachable
+
+"""
+The Outbound module. Sends the messages of a node to its neighbors in the background.
+
+Every neighbor has its own bounded queue and a worker thread that sends the messages of the queue in order,
+over the peer transport if both nodes use it, otherwise over a persistent HTTP session.
+A message that didn't reach the neighbor is sent again after a backoff that doubles every time.
+A slow or dead neighbor only fills its own queue: new messages for it are dropped when the queue is full
+and the other neighbors are not affected.
+"""
+
+
+class PeerQueue:
+    """
+    The queue and the worker thread of the messages to one neighbor.
+    """
+
+    def __init__(self, url, queue_size, retries, backoff, timeout, transport=None):
+        """
+        :param url: <str> The url of the neighbor.
+        :param queue_size: <int> The maximum number of messages waiting to be sent.
+        :param retries: <int> The number of times a message that didn't reach the neighbor is sent again.
+        :param backoff: <float> The time (in secs) to wait before the first retry.
+        :param timeout: <float> The time (in secs) to wait for a response.
+        :param transport: <PeerTransport> The transport to send the messages over, None to use only HTTP.
+        """
+        self.url = url
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.transport = transport
+        self.sent = 0
+        self.dropped = 0  # dropped because the queue was full
+        self.failed = 0  # dropped after the last retry failed
+        self.retried = 0
+        self.counters_lock = threading.Lock()  # the counters are changed by the worker and by the senders
+        self.running = True
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def put(self, message):
+        """
+        Queues a message, without waiting.
+
+        :param message: <tuple> (method, path, data, headers, on_response)
+        :return: <bool> True if the message was queued, False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.count('dropped')
+            return False
+
+    def run(self):
+        while self.running:
+            message = self.queue.get()
+            if message is None:
+                break
+            try:
+                self.deliver(message)
+            except Exception as e:
+                print("Could not handle the response of node {}: {}".format(self.url, e))
+        self.session.close()
+
+    def count(self, counter):
+        """
+        Increments one of the counters of the queue.
+
+        :param counter: <str> sent, dropped, failed or retried
+        """
+        self.counters_lock.acquire()
+        setattr(self, counter, getattr(self, counter) + 1)
+        self.counters_lock.release()
+
+    def deliver(self, message):
+        """
+        Sends a message, and sends it again with a backoff if it fails.
+        A message that got no response in time is a failed attempt too, and is sent again.
+
+        :param message: <tuple> (method, path, data, headers, on_response)
+                        on_response is called with the url of the neighbor and the decoded body
+                        of the response if the neighbor answered with 200, it can be None.
+        """
+        method, path, data, headers, on_response = message
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.count('retried')
+                sleep(delay)
+                delay *= 2
+            if self.transport is not None:
+                try:
+                    content_type = headers.get('Content-Type') if headers else None
+                    status, body = self.transport.request(self.url, method, path, data, content_type)
+                    self.count('sent')
+                    if on_response is not None and status == 200:
+                        on_response(self.url, body)
+                    return
+                except PeerUnreachable:
+                    pass  # the neighbor doesn't run the transport, HTTP is used instead
+                except PeerTransportError:  # including PeerTimeout
+                    if not self.running:
+                        break
+                    continue
+            try:
+                # any response counts, e.g. an invalid transaction is answered with 500 and is not sent again
+                response = self.session.request(method, '{}{}'.format(self.url, path), data=data, headers=headers,
+                                                timeout=self.timeout)
+                self.count('sent')
+                if on_response is not None and response.status_code == 200:
+                    content_type = response.headers.get('Content-Type', '').split(';')[0]
+                    on_response(self.url, wire.decode_message(response.content, content_type))
+                return
+            except requests.RequestException:  # including ReadTimeout
+                pass
+            if not self.running:
+                break
+        print("Could not contact node {}. Moving on...".format(self.url))
+        self.count('failed')
+
+    def stop(self):
+        """
+        Stops the worker after the message it is sending. The queued messages are dropped.
+        """
+        self.running = False
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def stats(self):
+        self.counters_lock.acquire()
+        stats = {
+            'depth': self.queue.qsize(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'retried': self.retried
+        }
+        self.counters_lock.release()
+        return stats
+
+
+class Outbound:
+    """
+    The outbound queues of a node, one for every neighbor it sends messages to.
+    """
+
+    def __init__(self, queue_size=1000, retries=3, backoff=0.5, timeout=5):
+        self.queue_size = queue_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.transport = None  # the PeerTransport, if the node uses it
+        self.peers = {}  # { url of the neighbor : PeerQueue }
+        self.lock = threading.Lock()
+
+    def peer(self, url):
+        """
+        Returns the queue of a neighbor, it is created the first time a message is sent to the neighbor.
+
+        :param url: <str> The url of the neighbor.
+        :return: <PeerQueue>
+        """
+        self.lock.acquire()
+        peer = self.peers.get(url)
+        if peer is None:
+            peer = PeerQueue(url, self.queue_size, self.retries, self.backoff, self.timeout, self.transport)
+            self.peers[url] = peer
+        self.lock.release()
+        return peer
+
+    def send(self, url, method, path, data=None, headers=None, on_response=None):
+        """
+        Queues a message to a neighbor and returns without waiting for it to be sent.
+
+        :param url: <str> The url of the neighbor.
+        :param method: <str> GET or POST
+        :param path: <str> The route, e.g. /alive
+        :param data: <bytes> The body of the request.
+        :param headers: <dict> The headers of the request.
+        :param on_response: <function> Called with the url of the neighbor and the decoded body of the response.
+        :return: <bool> True if the message was queued, False if the queue of the neighbor is full.
+        """
+        return self.peer(url).put((method, path, data, headers, on_response))
+
+    def broadcast(self, nodes, method, path, data=None, headers=None, on_response=None):
+        """
+        Queues a message to every neighbor.
+
+        :param nodes: The neighbors, as in Blockchain.nodes
+        :return: <int> The number of neighbors the message was queued to.
+        """
+        queued = 0
+        for node in nodes:
+            if self.send(node[0], method, path, data, headers, on_response):
+                queued += 1
+        return queued
+
+    def remove_peer(self, url):
+        """
+        Stops the worker of a neighbor that left the network and drops its queue.
+
+        :param url: <str> The url of the neighbor.
+        """
+        self.lock.acquire()
+        peer = self.peers.pop(url, None)
+        self.lock.release()
+        if peer is not None:
+            peer.stop()
+        if self.transport is not None:
+            self.transport.close(url)
+
+    def stats(self):
+        """
+        :return: <dict> { url of the neighbor : the queue depth and the counters of its messages }
+        """
+        self.lock.acquire()
+        peers = list(self.peers.values())
+        self.lock.release()
+        return {peer.url: peer.stats() for peer in peers}
+
+
+class Batcher:
+    """
+    Collects items, e.g. the transactions of a node, and sends them together.
+    A batch is sent when it has max_size items or window secs after its first item.
+    """
+
+    def __init__(self, send, window=0.05, max_size=100):
+        """
+        :param send: <function> Called with the list of the items of a batch.
+        :param window: <float> The time (in secs) an item can wait for more items.
+        :param max_size: <int> The maximum number of items in a batch.
+        """
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.items = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        """
+        Adds an item to the next batch, without waiting for the batch to be sent.
+        """
+        self.lock.acquire()
+        self.items.append(item)
+        full = len(self.items) >= self.max_size
+        if not full and self.timer is None:
+            self.timer = threading.Timer(self.window, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        self.lock.release()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the items that are waiting.
+        """
+        self.lock.acquire()
+        items = self.items
+        self.items = []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.lock.release()
+        if items:
+            self.send(items)
@@ -0,0 +1,326 @@
+import socket
+import struct
+import threading
+from time import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import wire
+
+"""
+The Peer Transport module. Sends the messages between nodes over long-lived TCP connections
+instead of a new HTTP request for every message.
+
+A node started with the transport listens on its port + peer_port_offset next to its Flask routes.
+Every message is a frame: a header with the length of the payload, a stream id and the kind of the frame,
+followed by the payload in the binary wire format. A request has the method, the route, the content type
+and the body of the message, and its response has the same stream id, so many requests can be in flight
+on one connection and their responses can arrive in any order.
+"""
+
+FRAME_HEADER = struct.Struct('>IIB')  # length of the payload, stream id, kind of the frame
+REQUEST, RESPONSE = range(2)
+
+
+class PeerTransportError(Exception):
+    """
+    Raised when a message can't be sent over the transport, e.g. the connection was closed.
+    """
+    pass
+
+
+class PeerUnreachable(PeerTransportError):
+    """
+    Raised when a node can't be connected to, e.g. it doesn't run the transport.
+    """
+    pass
+
+
+class PeerTimeout(PeerTransportError):
+    """
+    Raised when a node received a message but didn't respond in time.
+    """
+    pass
+
+
+def read_exactly(sock, length):
+    """
+    Reads length bytes from a socket.
+
+    :return: <bytes> The bytes, None if the connection was closed.
+    """
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+def read_frame(sock):
+    """
+    Reads a frame from a socket.
+
+    :return: <tuple> (stream id, kind of the frame, payload), None if the connection was closed.
+    """
+    header = read_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    length, stream, kind = FRAME_HEADER.unpack(header)
+    payload = read_exactly(sock, length)
+    if payload is None:
+        return None
+    return stream, kind, payload
+
+
+def write_frame(sock, write_lock, stream, kind, payload):
+    """
+    Writes a frame to a socket. The lock keeps the frames of different streams from interleaving.
+    """
+    write_lock.acquire()
+    try:
+        sock.sendall(FRAME_HEADER.pack(len(payload), stream, kind) + payload)
+    finally:
+        write_lock.release()
+
+
+class PeerConnection:
+    """
+    A connection to the transport of another node. It can be used by many threads at the same time.
+    """
+
+    def __init__(self, address, timeout):
+        """
+        :param address: <tuple> (host, port) of the transport of the node.
+        :param timeout: <float> The time (in secs) to wait for a response.
+        """
+        self.timeout = timeout
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.next_stream = 0
+        self.pending = {}  # { stream id : [Event, response] }, the requests waiting for their response
+        self.closed = False
+        threading.Thread(target=self.read_responses, daemon=True).start()
+
+    def request(self, method, path, data=None, content_type=None):
+        """
+        Sends a message and waits for its response.
+
+        :param method: <str> GET or POST
+        :param path: <str> The route, e.g. /alive
+        :param data: <bytes> The body of the message.
+        :param content_type: <str> The content type of the body.
+        :return: <tuple> (status code, body of the response)
+        """
+        waiter = [threading.Event(), None]
+        self.lock.acquire()
+        if self.closed:
+            self.lock.release()
+            raise PeerTransportError("The connection is closed")
+        stream = self.next_stream
+        self.next_stream = (self.next_stream + 1) & 0xffffffff
+        self.pending[stream] = waiter
+        self.lock.release()
+
+        try:
+            write_frame(self.sock, self.write_lock, stream, REQUEST, wire.dumps([method, path, content_type, data]))
+        except OSError as e:
+            self.close()
+            raise PeerTransportError(str(e))
+
+        if not waiter[0].wait(self.timeout):
+            self.lock.acquire()
+            self.pending.pop(stream, None)
+            self.lock.release()
+            raise PeerTimeout("No response in {} secs".format(self.timeout))
+        if waiter[1] is None:
+            raise PeerTransportError("The connection is closed")
+        return waiter[1]
+
+    def read_responses(self):
+        """
+        Reads the responses of the connection and wakes up the requests waiting for them.
+        """
+        try:
+            while True:
+                frame = read_frame(self.sock)
+                if frame is None:
+                    break
+                stream, kind, payload = frame
+                if kind != RESPONSE:
+                    continue
+                self.lock.acquire()
+                waiter = self.pending.pop(stream, None)
+                self.lock.release()
+                if waiter is not None:
+                    waiter[1] = tuple(wire.loads(payload))
+                    waiter[0].set()
+        except (OSError, wire.WireError):
+            pass
+        self.close()
+
+    def close(self):
+        self.lock.acquire()
+        self.closed = True
+        pending = list(self.pending.values())
+        self.pending.clear()
+        self.lock.release()
+        for waiter in pending:
+            waiter[0].set()  # the response is None
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class PeerTransport:
+    """
+    The connections of a node to the transports of its neighbors, one connection for every neighbor.
+    """
+
+    def __init__(self, port_offset, timeout, retry_interval=60):
+        """
+        :param port_offset: <int> The port of the transport of a node is its port + port_offset.
+        :param timeout: <float> The time (in secs) to wait for a connection or a response.
+        :param retry_interval: <float> The time (in secs) before connecting again to a node that couldn't be reached.
+        """
+        self.port_offset = port_offset
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.connections = {}  # { url of the node : PeerConnection }
+        self.unreachable = {}  # { url of the node : the time it couldn't be reached }
+        self.lock = threading.Lock()
+
+    def address(self, url):
+        """
+        Finds the address of the transport of a node.
+
+        :param url: <str> The url of the node, e.g. http://1.2.3.4:5000
+        :return: <tuple> (host, port)
+        """
+        parsed_url = urlparse(url)
+        return parsed_url.hostname, parsed_url.port + self.port_offset
+
+    def connection(self, url):
+        """
+        Returns the connection to a node, it is opened the first time a message is sent to the node.
+
+        :param url: <str> The url of the node.
+        :return: <PeerConnection>
+        """
+        self.lock.acquire()
+        try:
+            connection = self.connections.get(url)
+            if connection is not None and not connection.closed:
+                return connection
+            failed = self.unreachable.get(url)
+            if failed is not None and time() - failed < self.retry_interval:
+                raise PeerUnreachable("The node {} does not run the transport".format(url))
+            try:
+                connection = PeerConnection(self.address(url), self.timeout)
+            except OSError as e:
+                self.unreachable[url] = time()
+                raise PeerUnreachable(str(e))
+            self.unreachable.pop(url, None)
+            self.connections[url] = connection
+            return connection
+        finally:
+            self.lock.release()
+
+    def request(self, url, method, path, data=None, content_type=None):
+        """
+        Sends a message to a node and waits for its response.
+
+        :param url: <str> The url of the node.
+        :return: <tuple> (status code, body of the response)
+        """
+        return self.connection(url).request(method, path, data, content_type)
+
+    def close(self, url):
+        """
+        Closes the connection to a node, e.g. when it left the network.
+        """
+        self.lock.acquire()
+        connection = self.connections.pop(url, None)
+        self.lock.release()
+        if connection is not None:
+            connection.close()
+
+
+class PeerServer:
+    """
+    Receives the messages of other nodes over the transport and passes them to the handlers of the routes.
+    """
+
+    def __init__(self, host, port, routes, workers=8):
+        """
+        :param host: <str> The address to listen on.
+        :param port: <int> The port to listen on.
+        :param routes: <dict> { route : function(values) that returns (body, status code) }, the body is a string,
+                       or a dict or a list that is sent in the binary wire format
+        :param workers: <int> The number of messages that are handled at the same time.
+        """
+        self.routes = routes
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+
+    def start(self):
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+
+    def accept_connections(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                break  # the server was closed
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.read_requests, args=(sock,), daemon=True).start()
+
+    def read_requests(self, sock):
+        """
+        Reads the requests of a connection. Every request is handled by a worker,
+        so a slow request doesn't hold back the ones after it.
+        """
+        write_lock = threading.Lock()
+        try:
+            while True:
+                frame = read_frame(sock)
+                if frame is None:
+                    break
+                stream, kind, payload = frame
+                if kind == REQUEST:
+                    self.executor.submit(self.handle_request, sock, write_lock, stream, payload)
+        except OSError:
+            pass
+        sock.close()
+
+    def handle_request(self, sock, write_lock, stream, payload):
+        """
+        Passes a request to the handler of its route and sends back the response.
+        """
+        try:
+            method, path, content_type, data = wire.loads(payload)
+            handler = self.routes.get(path)
+            if handler is None:
+                body, status = "Unknown route", 404
+            else:
+                values = None if data is None else wire.decode_message(data, content_type)
+                body, status = handler(values)
+        except Exception as e:
+            body, status = "Could not handle the message: {}".format(e), 500
+
+        try:
+            body = body if isinstance(body, (dict, list)) else str(body)
+            write_frame(sock, write_lock, stream, RESPONSE, wire.dumps([status, body]))
+        except OSError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        self.executor.shutdown(wait=False)
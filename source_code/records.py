@@ -0,0 +1,195 @@
+import merkle
+
+"""
+The Records module. Compact, immutable records for the transactions that are stored in the blocks of the chain.
+
+A record keeps the fields of a transaction in slots instead of a nested dictionary and
+names the positions of its input, e.g. record.lease_duration instead of transaction['input'][4].
+The dictionary form (to_dict) is the one that is sent over the network and hashed in the Merkle tree.
+"""
+
+
+def freeze(value):
+    """
+    Converts the lists of a value to tuples, so that the value can't be changed.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class TransactionRecord:
+    """
+    TransactionRecord is the superclass of the records of all the transaction types.
+    """
+    __slots__ = ('type', 'input', 'output', 'timestamp', 'txid', 'signature', '_leaf_hash')
+
+    def __init__(self, type, input, output, timestamp, txid, signature=None):
+        set_field = object.__setattr__
+        set_field(self, 'type', type)
+        set_field(self, 'input', freeze(input))
+        set_field(self, 'output', freeze(output))
+        set_field(self, 'timestamp', timestamp)
+        set_field(self, 'txid', txid)
+        set_field(self, 'signature', freeze(signature))
+        set_field(self, '_leaf_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Transaction records are immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, TransactionRecord) and self.txid == other.txid and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(self.txid)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+    @staticmethod
+    def from_dict(transaction):
+        """
+        Creates the record of a transaction from its dictionary form.
+
+        :param transaction: <dict> A transaction, as it was received from the network, or a record.
+        :return: <TransactionRecord> The record of the right type.
+        """
+        if isinstance(transaction, TransactionRecord):
+            return transaction
+
+        if 'trans' not in transaction:
+            return GenesisRecord(transaction['input'], transaction['output'], transaction['timestamp'],
+                                 transaction['txid'])
+
+        trans = transaction['trans']
+        return new_record(trans['type'], trans['input'], trans['output'], trans['timestamp'], trans['txid'],
+                          transaction['signature'])
+
+    def to_dict(self):
+        """
+        Returns the dictionary form of the transaction, for json export.
+
+        :return: <dict>
+        """
+        return {
+            'trans': {
+                'type': self.type,
+                'input': self.input,
+                'output': self.output,
+                'timestamp': self.timestamp,
+                'txid': self.txid
+            },
+            'signature': self.signature
+        }
+
+    def leaf_hash(self):
+        """
+        Returns the hash of the transaction in the Merkle tree of its block.
+        It is calculated only once.
+
+        :return: <str>
+        """
+        if self._leaf_hash is None:
+            object.__setattr__(self, '_leaf_hash', merkle.transaction_hash(self.to_dict()))
+        return self._leaf_hash
+
+
+class GenesisRecord(TransactionRecord):
+    """
+    The transaction of the genesis block, input and output: [ (prefix, AS), ... ]
+    """
+    __slots__ = ()
+
+    def __init__(self, input, output, timestamp, txid=-1):
+        super().__init__("Genesis", input, output, timestamp, txid)
+
+    def to_dict(self):
+        return {
+            'input': self.input,
+            'output': self.output,
+            'txid': self.txid,
+            'timestamp': self.timestamp
+        }
+
+
+class AssignRecord(TransactionRecord):
+    """
+    input: [prefix, AS source, AS destination list, source lease, lease duration, transfer tag, last assign txid]
+    """
+    __slots__ = ()
+
+    prefix = property(lambda self: self.input[0])
+    as_source = property(lambda self: self.input[1])
+    as_dest = property(lambda self: self.input[2])
+    source_lease = property(lambda self: self.input[3])
+    lease_duration = property(lambda self: self.input[4])
+    transfer_tag = property(lambda self: self.input[5])
+    last_assign = property(lambda self: self.input[6])
+
+
+class RevokeRecord(TransactionRecord):
+    """
+    input: [AS source, assign txid], output: [ (prefix, AS source, new lease duration, transfer tag) ]
+    """
+    __slots__ = ()
+
+    as_source = property(lambda self: self.input[0])
+    assign_txid = property(lambda self: self.input[1])
+    new_lease = property(lambda self: self.output[0][2])
+    transfer_tag = property(lambda self: self.output[0][3])
+
+
+class UpdateRecord(TransactionRecord):
+    """
+    input: [AS source, assign txid, new lease duration]
+    """
+    __slots__ = ()
+
+    as_source = property(lambda self: self.input[0])
+    assign_txid = property(lambda self: self.input[1])
+    new_lease = property(lambda self: self.input[2])
+
+
+class BGPAnnounceRecord(TransactionRecord):
+    """
+    input: [prefix, advertising AS, AS source list, AS destination list, BGP timestamp],
+    output: [ (prefix, AS source, advertising AS, AS destination), ... ]
+    """
+    __slots__ = ()
+
+    prefix = property(lambda self: self.input[0])
+    as_source = property(lambda self: self.input[1])
+    as_source_list = property(lambda self: self.input[2])
+    as_dest_list = property(lambda self: self.input[3])
+    bgp_timestamp = property(lambda self: self.input[4])
+    sub_paths = property(lambda self: self.output)
+
+
+class BGPWithdrawRecord(TransactionRecord):
+    """
+    input: [prefix, withdrawing AS, BGP timestamp]
+    """
+    __slots__ = ()
+
+    prefix = property(lambda self: self.input[0])
+    as_source = property(lambda self: self.input[1])
+    bgp_timestamp = property(lambda self: self.input[2])
+
+
+RECORD_TYPES = {
+    "Assign": AssignRecord,
+    "Revoke": RevokeRecord,
+    "Update": UpdateRecord,
+    "BGP Announce": BGPAnnounceRecord,
+    "BGP Withdraw": BGPWithdrawRecord
+}
+
+
+def new_record(type, input, output, timestamp, txid, signature):
+    """
+    Creates the record of a transaction of the given type.
+
+    :return: <TransactionRecord>
+    """
+    record_class = RECORD_TYPES.get(type, TransactionRecord)
+    return record_class(type, input, output, timestamp, txid, signature)
@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+from records import freeze
+
+"""
+The Signature Cache module. Remembers the result of the last RSA signature verifications,
+so that a transaction or a block whose signature was already verified is not verified again,
+e.g. when a transaction is validated on arrival and again when it is rebuilt from a block.
+
+An entry is keyed by the public key (its modulus and exponent), the signed hash and the signature.
+A verification only depends on these, so both valid and invalid results are kept.
+"""
+
+
+class SignatureCache:
+    """
+    A bounded LRU cache of signature verifications, with hit and miss counters.
+    """
+
+    def __init__(self, size=10000):
+        """
+        :param size: <int> The number of verifications that are kept.
+        """
+        self.size = size
+        self.entries = OrderedDict()  # { (public key fingerprint, hash, signature) : True if valid }
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def verify(self, public_key, message_hash, signature):
+        """
+        Verifies a signature, or returns the result of its last verification.
+
+        :param public_key: <RSA key> The public key of the signer.
+        :param message_hash: <str> The hash that was signed.
+        :param signature: <tuple> The signature.
+        :return: <bool> True if the signature is valid, False otherwise.
+        """
+        valid = self.lookup(public_key, message_hash, signature)
+        if valid is None:
+            valid = bool(public_key.verify(message_hash.encode(), signature))  # not under the lock, it is slow
+            self.add(public_key, message_hash, signature, valid)
+        return valid
+
+    def lookup(self, public_key, message_hash, signature):
+        """
+        Returns the result of the last verification of a signature, without verifying it.
+
+        :return: <bool> True if the signature is valid, False if it is not, None if it is not in the cache.
+        """
+        key = ((public_key.n, public_key.e), message_hash, freeze(signature))
+        self.lock.acquire()
+        valid = self.entries.get(key)
+        if valid is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+        return valid
+
+    def add(self, public_key, message_hash, signature, valid):
+        """
+        Remembers the result of a verification, e.g. one that was done in a validation process.
+        """
+        key = ((public_key.n, public_key.e), message_hash, freeze(signature))
+        self.lock.acquire()
+        self.entries[key] = valid
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.lock.release()
+
+    def stats(self):
+        """
+        :return: <dict> The number of entries, hits and misses and the hit rate of the cache.
+        """
+        self.lock.acquire()
+        lookups = self.hits + self.misses
+        stats = {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+        self.lock.release()
+        return stats
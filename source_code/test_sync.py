@@ -0,0 +1,168 @@
+import json
+import unittest
+from time import time
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+import Blockchain as blockchain_module
+import benchmark
+from Blockchain import blockchain
+from Block import Block
+from BGP_Transaction import BGP_Announce
+from config import AS_registry, node_key, target_block_time, state, AS_topo, txid_to_block
+
+"""
+Tests of the chain synchronization. Run them from the source_code directory:
+    $ python3 -m unittest test_sync
+"""
+
+PEER = 'http://peer:5000'
+PEER_ASN = 'test-peer'
+
+
+class FakeResponse:
+    """
+    A response of requests.get with a JSON body, it can also be read in chunks like a streamed response.
+    """
+    status_code = 200
+
+    def __init__(self, values):
+        self.content = json.dumps(values).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), 64):
+            yield self.content[start:start + 64]
+
+    def close(self):
+        pass
+
+
+def mine_chain(base, length):
+    """
+    Mines empty blocks on top of a chain until it has the given length.
+
+    :return: <list> The new chain.
+    """
+    chain = list(base)
+    while len(chain) < length:
+        index = len(chain)
+        block = Block(index, chain[-1].timestamp + target_block_time, [], chain[-1].hash,
+                      blockchain.next_difficulty(chain, index))
+        block.proof_of_work()
+        block.mined_timestamp = time()
+        block.sign(node_key.sign(block.calculate_hash().encode(), ''))
+        block.mined_by(PEER_ASN)
+        chain.append(block)
+    return chain
+
+
+def hashes(chain):
+    return [block.hash for block in chain]
+
+
+def snapshot():
+    """
+    :return: <tuple> A copy of the state, the topologies and the txid_to_block dictionary.
+    """
+    return ({prefix: list(prefix_state) for prefix, prefix_state in state.items()},
+            {prefix: sorted(topo.edges) for prefix, topo in AS_topo.items()}, dict(txid_to_block))
+
+
+def serve(chain):
+    """
+    Answers the requests of a node that syncs with a neighbor that has the given chain.
+    """
+    def get(url, params=None, **kwargs):
+        start = params.get('from', 0) if params else 0
+        end = params.get('to', len(chain)) if params else len(chain)
+        if url == PEER + '/tip':
+            # the work is added up here, the work cache of our node is keyed by verified hashes only
+            work = sum(16 ** block.difficulty for block in chain)
+            return FakeResponse({'length': len(chain), 'hash': chain[-1].hash, 'work': work})
+        if url == PEER + '/headers':
+            return FakeResponse({'headers': [block.header() for block in chain[start:end]]})
+        if url == PEER + '/bodies':
+            bodies = [{'index': block.index, 'transactions': [tran.to_dict() for tran in block.transactions]}
+                      for block in chain[start:end]]
+            return FakeResponse({'bodies': bodies})
+        raise AssertionError("Unexpected request {}".format(url))
+    return get
+
+
+class TestSync(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        benchmark.prepare_network()  # the ASes of the benchmark transactions sign with the node's key
+
+    def setUp(self):
+        AS_registry.add('peer', 5000, PEER_ASN, node_key.publickey())
+        self.nodes = set(blockchain.nodes)
+        blockchain.nodes.add((PEER, PEER_ASN))
+        blockchain.validated_headers.clear()
+        blockchain_module.signature_cache.entries.clear()
+
+    def tearDown(self):
+        blockchain.nodes.clear()
+        blockchain.nodes.update(self.nodes)
+        AS_registry.remove('peer', 5000)
+
+    def test_sync_validates_the_signatures_on_the_pool(self):
+        # 8 new blocks in chunks of 2: the headers of the candidate are validated in one call on the pool
+        peer_chain = mine_chain(blockchain.chain, len(blockchain.chain) + 8)
+        pool = mock.Mock(wraps=ProcessPoolExecutor)
+
+        with mock.patch.object(blockchain_module.requests, 'get', side_effect=serve(peer_chain)), \
+                mock.patch.object(blockchain_module, 'ProcessPoolExecutor', pool), \
+                mock.patch.object(blockchain_module, 'validation_chunk_size', 2), \
+                mock.patch.object(blockchain_module, 'validation_workers', 2):
+            blockchain.validation_pool = None
+            try:
+                self.assertTrue(blockchain.resolve_conflicts())
+                executor = blockchain.validation_pool
+            finally:
+                if blockchain.validation_pool is not None:
+                    blockchain.validation_pool.shutdown()
+                blockchain.validation_pool = None
+
+        self.assertEqual(pool.call_count, 1)
+        self.assertIn(pool.call_args.kwargs['mp_context'].get_start_method(), ('forkserver', 'spawn'))
+        self.assertIsNotNone(executor)
+        self.assertEqual(hashes(blockchain.chain), hashes(peer_chain))
+
+    def test_reorg_rolls_back_the_state_with_the_undo_logs(self):
+        # our last block announces a route, the neighbor's chain forks before it and has more work
+        base = list(blockchain.chain)
+        before = snapshot()
+        announce = benchmark.signed(BGP_Announce(benchmark.BGP_PREFIX, time(), benchmark.BGP_ORIGIN, ['0'],
+                                                 [benchmark.BGP_NEIGHBOR], time()))
+        self.assertTrue(announce.validate_transaction())
+        benchmark.mine_block([announce.return_transaction()])
+        self.assertNotEqual(snapshot(), before)
+        peer_chain = mine_chain(base, len(base) + 2)
+
+        with mock.patch.object(blockchain_module.requests, 'get', side_effect=serve(peer_chain)), \
+                mock.patch.object(blockchain, 'rebuild_state', wraps=blockchain.rebuild_state) as rebuild_state:
+            self.assertTrue(blockchain.resolve_conflicts())
+
+        rebuild_state.assert_not_called()
+        self.assertEqual(hashes(blockchain.chain), hashes(peer_chain))
+        self.assertEqual(snapshot(), before)
+
+    def test_sync_rejects_a_forged_block_hash(self):
+        # the neighbor's chain has more work, but one of its blocks claims the hash of our last block
+        our_chain = list(blockchain.chain)
+        peer_chain = mine_chain(our_chain, len(our_chain) + 3)
+        peer_chain[-2].hash = our_chain[-1].hash
+
+        with mock.patch.object(blockchain_module.requests, 'get', side_effect=serve(peer_chain)):
+            self.assertFalse(blockchain.resolve_conflicts())
+
+        self.assertEqual(hashes(blockchain.chain), hashes(our_chain))
+        self.assertTrue(blockchain.valid_chain(blockchain.chain))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+from Crypto.PublicKey import RSA
+
+"""
+The Validator module. Checks the signatures of the miners of blocks in a separate process,
+so that the blocks of a long chain can be checked on multiple cores (see Blockchain.first_invalid_header).
+"""
+
+public_keys = {}  # { exported public key : RSA key }, the keys this process has imported
+
+
+def import_key(exported_key):
+    """
+    Imports an exported public key, once per process.
+
+    :param exported_key: <bytes> The public key, as returned by exportKey.
+    :return: The RSA key.
+    """
+    key = public_keys.get(exported_key)
+    if key is None:
+        key = RSA.importKey(exported_key)
+        public_keys[exported_key] = key
+    return key
+
+
+def verify_signatures(signatures):
+    """
+    Checks the signatures of the miners of blocks.
+    Runs in a separate process, so the public keys are sent exported.
+
+    :param signatures: <list> [ (hash of the block, signature, exported public key of the miner), ... ]
+                       The key is None if the miner is unknown.
+    :return: <list> [ True if the signature is valid, ... ]
+    """
+    results = []
+    for block_hash, signature, exported_key in signatures:
+        results.append(exported_key is not None and import_key(exported_key).verify(block_hash.encode(), signature))
+    return results
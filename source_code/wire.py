@@ -0,0 +1,504 @@
+import json
+import codecs
+import struct
+from Block import Block
+from records import GenesisRecord, RECORD_TYPES
+
+"""
+The Wire module. A compact binary encoding of blocks and transactions for the network and for storage.
+
+Every value is a one byte tag followed by its data. Lengths and small integers are varints,
+so every field is length-prefixed. Transaction types are stored as integer codes.
+JSON is still available for debugging, the binary format is used when a request asks for it.
+"""
+
+VERSION = 1
+CONTENT_TYPE = 'application/octet-stream'
+
+# value tags
+NONE, TRUE, FALSE, INT, BIG_INT, FLOAT, STR, LIST, TUPLE, DICT, BYTES = range(11)
+
+# transaction type codes, 0 is the genesis transaction
+TRANSACTION_TYPES = ["Genesis", "Assign", "Revoke", "Update", "BGP Announce", "BGP Withdraw"]
+TRANSACTION_CODES = {tran_type: code for code, tran_type in enumerate(TRANSACTION_TYPES)}
+
+FLOAT_FORMAT = struct.Struct('>d')
+
+
+class WireError(Exception):
+    """
+    Raised when a message can't be decoded.
+    """
+    pass
+
+
+def write_varint(out, n):
+    """
+    Appends an unsigned integer to the output, 7 bits per byte.
+    """
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    """
+    Reads an unsigned integer.
+
+    :return: <tuple> The integer and the position after it.
+    """
+    n = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise WireError("Truncated varint")
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def write_value(out, value):
+    """
+    Appends a value (None, bool, int, float, str, bytes, list, tuple or dict) to the output.
+    """
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        if -2 ** 62 <= value < 2 ** 62:
+            out.append(INT)
+            write_varint(out, (value << 1) ^ (value >> 63))  # zigzag, small negative numbers stay small
+        else:
+            # e.g. the RSA signatures
+            raw = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+            out.append(BIG_INT)
+            write_varint(out, len(raw))
+            out += raw
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += FLOAT_FORMAT.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode()
+        out.append(STR)
+        write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(BYTES)
+        write_varint(out, len(value))
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST if isinstance(value, list) else TUPLE)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            write_value(out, key)
+            write_value(out, item)
+    else:
+        raise WireError("Can't encode a value of type {}".format(type(value).__name__))
+
+
+def read_value(data, pos):
+    """
+    Reads a value.
+
+    :return: <tuple> The value and the position after it.
+    """
+    try:
+        tag = data[pos]
+    except IndexError:
+        raise WireError("Truncated value")
+    pos += 1
+
+    if tag == NONE:
+        return None, pos
+    elif tag == TRUE:
+        return True, pos
+    elif tag == FALSE:
+        return False, pos
+    elif tag == INT:
+        n, pos = read_varint(data, pos)
+        return (n >> 1) ^ -(n & 1), pos
+    elif tag == BIG_INT:
+        length, pos = read_varint(data, pos)
+        return int.from_bytes(read_bytes(data, pos, length), 'big', signed=True), pos + length
+    elif tag == FLOAT:
+        return FLOAT_FORMAT.unpack(read_bytes(data, pos, 8))[0], pos + 8
+    elif tag == STR:
+        length, pos = read_varint(data, pos)
+        return read_bytes(data, pos, length).decode(), pos + length
+    elif tag == BYTES:
+        length, pos = read_varint(data, pos)
+        return bytes(read_bytes(data, pos, length)), pos + length
+    elif tag == LIST or tag == TUPLE:
+        length, pos = read_varint(data, pos)
+        items = []
+        for _ in range(length):
+            item, pos = read_value(data, pos)
+            items.append(item)
+        return (items if tag == LIST else tuple(items)), pos
+    elif tag == DICT:
+        length, pos = read_varint(data, pos)
+        values = {}
+        for _ in range(length):
+            key, pos = read_value(data, pos)
+            values[key], pos = read_value(data, pos)
+        return values, pos
+    raise WireError("Unknown tag {}".format(tag))
+
+
+def read_bytes(data, pos, length):
+    """
+    Reads length bytes.
+    """
+    if pos + length > len(data):
+        raise WireError("Truncated data")
+    return data[pos:pos + length]
+
+
+def dumps(value):
+    """
+    Encodes a value.
+
+    :return: <bytes>
+    """
+    out = bytearray([VERSION])
+    write_value(out, value)
+    return bytes(out)
+
+
+def loads(data):
+    """
+    Decodes a value that was encoded with dumps.
+    """
+    check_version(data)
+    value, pos = read_value(data, 1)
+    return value
+
+
+def check_version(data):
+    """
+    Checks the version byte of a message.
+    """
+    if len(data) == 0 or data[0] != VERSION:
+        raise WireError("Unsupported wire format version")
+
+
+""" ---------------------------------------------Transactions and blocks--------------------------------------------- """
+
+
+def write_transaction(out, transaction):
+    """
+    Appends a transaction of a block to the output.
+
+    :param transaction: <TransactionRecord> A transaction record.
+    """
+    out.append(TRANSACTION_CODES[transaction.type])
+    write_value(out, transaction.input)
+    write_value(out, transaction.output)
+    write_value(out, transaction.timestamp)
+    write_value(out, transaction.txid)
+    if transaction.type != "Genesis":
+        write_value(out, transaction.signature)
+
+
+def read_transaction(data, pos):
+    """
+    Reads a transaction of a block.
+
+    :return: <tuple> The transaction (<TransactionRecord>) and the position after it.
+    """
+    code = read_bytes(data, pos, 1)[0]
+    pos += 1
+    if code >= len(TRANSACTION_TYPES):
+        raise WireError("Unknown transaction type {}".format(code))
+
+    input, pos = read_value(data, pos)
+    output, pos = read_value(data, pos)
+    timestamp, pos = read_value(data, pos)
+    txid, pos = read_value(data, pos)
+
+    if code == TRANSACTION_CODES["Genesis"]:
+        return GenesisRecord(input, output, timestamp, txid), pos
+
+    signature, pos = read_value(data, pos)
+    tran_type = TRANSACTION_TYPES[code]
+    return RECORD_TYPES[tran_type](tran_type, input, output, timestamp, txid, signature), pos
+
+
+def write_transactions(out, transactions):
+    """
+    Appends a list of transaction records to the output, every transaction prefixed with its length.
+    """
+    write_varint(out, len(transactions))
+    for transaction in transactions:
+        encoded = bytearray()
+        write_transaction(encoded, transaction)
+        write_varint(out, len(encoded))
+        out += encoded
+
+
+def read_transactions(data, pos):
+    """
+    Reads a list of transactions.
+
+    :return: <tuple> The transactions and the position after them.
+    """
+    count, pos = read_varint(data, pos)
+    transactions = []
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        transaction, end = read_transaction(data, pos)
+        if end != pos + length:
+            raise WireError("Transaction length mismatch")
+        transactions.append(transaction)
+        pos = end
+    return transactions, pos
+
+
+def encode_block(block, with_transactions=True):
+    """
+    Encodes a block. Without its transactions a block is encoded as its header.
+
+    :param block: <Block>
+    :param with_transactions: <bool> Whether to encode the transactions of the block.
+    :return: <bytes>
+    """
+    out = bytearray([VERSION])
+    write_value(out, block.index)
+    write_value(out, block.timestamp)
+    write_value(out, block.previousHash)
+    write_value(out, block.merkle_root)
+    write_value(out, block.nonce)
+    write_value(out, block.difficulty)
+    write_value(out, block.hash)
+    write_value(out, block.miner)
+    write_value(out, block.signature)
+    write_value(out, block.mined_timestamp)
+    write_transactions(out, block.transactions if with_transactions else [])
+    return bytes(out)
+
+
+def decode_block(data):
+    """
+    Decodes a block that was encoded with encode_block.
+
+    :return: <Block>
+    """
+    check_version(data)
+    fields = []
+    pos = 1
+    for _ in range(10):
+        value, pos = read_value(data, pos)
+        fields.append(value)
+    transactions, pos = read_transactions(data, pos)
+
+    index, timestamp, previousHash, merkle_root, nonce, difficulty, hash, miner, signature, mined_timestamp = fields
+    block = Block(index, timestamp, transactions, previousHash, difficulty, merkle_root)
+    block.nonce = nonce
+    block.hash = hash
+    block.miner = miner
+    block.signature = signature
+    block.mined_timestamp = mined_timestamp
+    return block
+
+
+def encode_body(block):
+    """
+    Encodes the index and the transactions of a block.
+
+    :return: <bytes>
+    """
+    out = bytearray([VERSION])
+    write_value(out, block.index)
+    write_transactions(out, block.transactions)
+    return bytes(out)
+
+
+def decode_body(data):
+    """
+    Decodes a block body that was encoded with encode_body.
+
+    :return: <dict> {'index': the block index, 'transactions': the transactions}
+    """
+    check_version(data)
+    index, pos = read_value(data, 1)
+    transactions, pos = read_transactions(data, pos)
+    return {'index': index, 'transactions': transactions}
+
+
+def frame(items):
+    """
+    Joins encoded items into one message, every item prefixed with its length.
+
+    :param items: <list> Encoded blocks, headers or bodies.
+    :return: <bytes>
+    """
+    out = bytearray([VERSION])
+    write_varint(out, len(items))
+    for item in items:
+        write_varint(out, len(item))
+        out += item
+    return bytes(out)
+
+
+def unframe(data):
+    """
+    Splits a message that was created with frame into its items.
+
+    :return: <list> The encoded items.
+    """
+    check_version(data)
+    count, pos = read_varint(data, 1)
+    items = []
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        items.append(read_bytes(data, pos, length))
+        pos += length
+    return items
+
+
+def has_varint(data, pos):
+    """
+    Checks if a whole varint has been received at a position of the data.
+    """
+    for byte in data[pos:pos + 10]:
+        if byte < 0x80:
+            return True
+    return False
+
+
+def iter_unframe(chunks):
+    """
+    Splits a message that was created with frame into its items while it is being received.
+    Every item is yielded as soon as all of its bytes have arrived.
+
+    :param chunks: <iterable> The parts of the message, as they are received.
+    :return: <generator> The encoded items.
+    """
+    chunks = iter(chunks)
+    buffer = bytearray()
+    pos = 0
+    count = None
+    items = 0
+
+    while count is None or items < count:
+        if count is None:
+            if len(buffer) > 0:
+                check_version(buffer)
+                if has_varint(buffer, 1):
+                    count, pos = read_varint(buffer, 1)
+                    continue
+        elif has_varint(buffer, pos):
+            length, start = read_varint(buffer, pos)
+            if start + length <= len(buffer):
+                yield bytes(buffer[start:start + length])
+                items += 1
+                del buffer[:start + length]  # drop the bytes of the items that were yielded
+                pos = 0
+                continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise WireError("Truncated message")
+        buffer += chunk
+
+
+def iter_json_items(chunks):
+    """
+    Decodes the items of the first list of a JSON message while it is being received, e.g. the blocks of /blocks.
+    Every item is yielded as soon as all of its bytes have arrived.
+
+    :param chunks: <iterable> The parts of the message, as they are received.
+    :return: <generator> The decoded items.
+    """
+    chunks = iter(chunks)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    json_decoder = json.JSONDecoder()
+    text = ''
+    pos = None  # the position after the last item in text
+
+    while True:
+        if pos is None:
+            start = text.find('[')
+            if start >= 0:
+                pos = start + 1
+                continue
+        else:
+            while pos < len(text) and text[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(text):
+                if text[pos] == ']':
+                    return
+                try:
+                    item, end = json_decoder.raw_decode(text, pos)
+                except json.JSONDecodeError:
+                    pass  # the item has not been received yet
+                else:
+                    yield item
+                    text = text[end:]
+                    pos = 0
+                    continue
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise WireError("Truncated message")
+        text += text_decoder.decode(chunk)
+
+
+def encode_chain(chain, with_transactions=True):
+    """
+    Encodes a chain of blocks.
+
+    :return: <bytes>
+    """
+    return frame([encode_block(block, with_transactions) for block in chain])
+
+
+def decode_chain(data):
+    """
+    Decodes a chain of blocks that was encoded with encode_chain.
+
+    :return: <list> A chain of Block objects.
+    """
+    return [decode_block(item) for item in unframe(data)]
+
+
+""" ---------------------------------------------------Messages---------------------------------------------------- """
+
+
+def encode_message(values, binary):
+    """
+    Encodes a message (e.g. a transaction) that is posted to another node.
+
+    :param values: <dict> The message.
+    :param binary: <bool> Whether to use the binary format instead of JSON.
+    :return: <tuple> The encoded message and the HTTP headers to send with it.
+    """
+    if binary:
+        return dumps(values), {"Content-Type": CONTENT_TYPE}
+    return json.dumps(values), {"Content-Type": "application/json"}
+
+
+def decode_message(data, content_type):
+    """
+    Decodes a message that was encoded with encode_message.
+
+    :param data: <bytes> The body of the request.
+    :param content_type: <str> The content type of the request.
+    :return: <dict> The message.
+    """
+    if content_type == CONTENT_TYPE:
+        return loads(data)
+    return json.loads(data)